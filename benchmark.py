@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+#
+# performance benchmarks for rePear, the iPod database management tool
+# Copyright (C) 2008 Martin J. Fiedler <martin.fiedler@gmx.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys, os, time, random, struct, types, shutil, tempfile, subprocess, optparse
+
+# the benchmarks run against the rePear modules from this directory
+import repear, iTunesDB, timing
+
+
+################################################################################
+## benchmark registry and helpers                                             ##
+################################################################################
+
+benchmarks = []
+
+def benchmark(func):
+    benchmarks.append((func.__name__.replace('bench_', '').replace('_', '-'), func))
+    return func
+
+# results of all benchmarks, written to the report file at the end
+results = {}
+
+def timed(func, *args):
+    t0 = time.time()
+    res = func(*args)
+    return (time.time() - t0, res)
+
+def report(name, seconds, items=None):
+    line = "%-32s %8.3f s" % (name, seconds)
+    if items and seconds > 0:
+        line += "  (%d items, %.0f items/s)" % (items, items / seconds)
+    print line
+
+
+# a synthetic music library: <artists> artists with a random number of
+# albums each, with a random number of tracks per album
+def make_library(tracks, seed=0):
+    rnd = random.Random(seed)
+    paths = []
+    artist = 0
+    while len(paths) < tracks:
+        artist += 1
+        for album in xrange(1, rnd.randint(1, 8) + 1):
+            for track in xrange(1, rnd.randint(5, 20) + 1):
+                paths.append(u"Music/Artist %d/Album %d/%02d - Track.mp3" % (artist, album, track))
+    return paths[:tracks]
+
+
+################################################################################
+## synthetic iPod generator                                                   ##
+################################################################################
+
+# MPEG-1 Layer III frames (44.1 kHz, stereo, no padding) for some bitrates;
+# the audio data is just zeros
+mp3_bitrate_codes = { 128: 9, 160: 10, 192: 11 }
+
+def mp3_frame(bitrate, payload=""):
+    size = 144000 * bitrate / 44100
+    header = "\xff\xfb" + chr(mp3_bitrate_codes[bitrate] << 4) + "\0"
+    # VBR info headers follow the 32 bytes of side information
+    if payload:
+        payload = 32 * "\0" + payload
+    return header + payload + (size - 4 - len(payload)) * "\0"
+
+def mp3_stream(frames, kind):
+    if kind == "cbr":
+        return mp3_frame(128) * frames
+    # VBR: alternating bitrates, with an info header in the first frame
+    data = [mp3_frame((128, 160, 192)[i % 3]) for i in xrange(frames)]
+    total = sum(map(len, data)) + len(mp3_frame(128))
+    if kind == "xing":
+        info = "Xing\0\0\0\x03" + struct.pack(">ii", frames + 1, total)
+    elif kind == "vbri":
+        info = "VBRI\0\1\0\0\0\0" + struct.pack(">ii", total, frames + 1)
+    return mp3_frame(128, info) + "".join(data)
+
+def id3v1(title, artist, album, year, track, genre):
+    return "TAG" + title[:30].ljust(30, "\0") + artist[:30].ljust(30, "\0") \
+         + album[:30].ljust(30, "\0") + str(year)[:4].ljust(4, "\0") \
+         + 28 * "\0" + "\0" + chr(track & 0xFF) + chr(genre)
+
+def syncsafe(n):
+    return "".join([chr((n >> shift) & 0x7F) for shift in (21, 14, 7, 0)])
+
+def id3v2(fields, padding=256):
+    frames = []
+    for frame, text in fields:
+        payload = "\0" + text  # ISO-8859-1 text
+        frames.append(frame + struct.pack(">L", len(payload)) + "\0\0" + payload)
+    data = "".join(frames) + padding * "\0"
+    return "ID3\3\0\0" + syncsafe(len(data)) + data
+
+def atom(name, *payload):
+    payload = "".join(payload)
+    return struct.pack(">L", len(payload) + 8) + name + payload
+
+def mp4_file(title, artist, album, track, seconds, cover=None):
+    rate = 44100
+    esds = atom("esds", "\0\0\0\0",
+        "\x03\x19\0\x01\0",                         # ES descriptor
+        "\x04\x11\x40\x15\0\0\0", struct.pack(">LL", 128000, 128000),
+        "\x05\x02\x12\x10",                         # LC-AAC, 44.1 kHz, stereo
+        "\x06\x01\x02")                             # SL config
+    mp4a = "\0\0\0\0\0\0\0\x01" + struct.pack(">HHLHHHHHH", 0, 0, 0, 2, 16, 0, 0, rate, 0) + esds
+    stsd = atom("stsd", "\0\0\0\0", struct.pack(">L", 1),
+        struct.pack(">L", len(mp4a) + 8) + "mp4a" + mp4a)
+    trak = atom("trak",
+        atom("tkhd", "\0\0\0\x01", 8 * "\0", struct.pack(">LLL", 1, 0, seconds * rate), 60 * "\0"),
+        atom("mdia",
+            atom("mdhd", 12 * "\0", struct.pack(">LL", rate, seconds * rate), 4 * "\0"),
+            atom("hdlr", 8 * "\0", "soun", 12 * "\0", "\0"),
+            atom("minf", atom("stbl", stsd))))
+    def text(name, value):
+        return atom(name, atom("data", "\0\0\0\x01\0\0\0\0", value))
+    items = [text("\xa9nam", title), text("\xa9ART", artist), text("\xa9alb", album),
+             atom("trkn", atom("data", 8 * "\0", struct.pack(">HHH", 0, track, 0), "\0\0"))]
+    if cover:
+        items.append(atom("covr", atom("data", "\0\0\0\x0d\0\0\0\0", cover)))
+    udta = atom("udta", atom("meta", "\0\0\0\0",
+        atom("hdlr", 8 * "\0", "mdirappl", 9 * "\0"),
+        atom("ilst", *items)))
+    moov = atom("moov",
+        atom("mvhd", 12 * "\0", struct.pack(">LL", rate, seconds * rate), 80 * "\0"),
+        trak, udta)
+    return atom("ftyp", "M4A \0\0\0\0M4A mp42isom") + moov + atom("mdat", 4096 * "\0")
+
+# Ogg page CRC (polynomial 0x04C11DB7, not bit-reflected)
+ogg_crc_table = []
+for i in xrange(256):
+    r = i << 24
+    for j in xrange(8):
+        if r & 0x80000000:
+            r = ((r << 1) ^ 0x04C11DB7) & 0xFFFFFFFF
+        else:
+            r = (r << 1) & 0xFFFFFFFF
+    ogg_crc_table.append(r)
+
+def ogg_page(packets, granule, serial, seqno, flags=0):
+    lacing = []
+    for packet in packets:
+        lacing.append((len(packet) // 255) * "\xff" + chr(len(packet) % 255))
+    lacing = "".join(lacing)
+    page = ["OggS\0", chr(flags), struct.pack("<qLL", granule, serial, seqno), "\0\0\0\0",
+            chr(len(lacing)), lacing] + packets
+    page = "".join(page)
+    crc = 0
+    for c in page:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ ogg_crc_table[(crc >> 24) ^ ord(c)]
+    return page[:22] + struct.pack("<L", crc) + page[26:]
+
+def ogg_file(title, artist, album, track, seconds, serial):
+    rate = 44100
+    ident = "\x01vorbis" + struct.pack("<LBLlll", 0, 2, rate, 0, 128000, 0) + "\xb8\x01"
+    comments = ["TITLE=" + title, "ARTIST=" + artist, "ALBUM=" + album, "TRACKNUMBER=%d" % track]
+    vendor = "rePear benchmark"
+    comment = "\x03vorbis" + struct.pack("<L", len(vendor)) + vendor + struct.pack("<L", len(comments)) \
+            + "".join([struct.pack("<L", len(c)) + c for c in comments]) + "\x01"
+    setup = "\x05vorbis" + 64 * "\0"
+    pages = [ogg_page([ident], 0, serial, 0, 2), ogg_page([comment, setup], 0, serial, 1)]
+    for i in xrange(1, 5):
+        pages.append(ogg_page([200 * "\0"], seconds * rate * i / 4, serial, i + 1, (i == 4) and 4 or 0))
+    return "".join(pages)
+
+def jpeg_file():
+    if iTunesDB.PILAvailable:
+        import Image, StringIO
+        buf = StringIO.StringIO()
+        Image.new('RGB', (300, 300), (200, 120, 40)).save(buf, "JPEG")
+        return buf.getvalue()
+    # without PIL, artwork can't be processed anyway; use a bare JFIF stub
+    return "\xff\xd8\xff\xe0\0\x10JFIF\0\1\1\0\0\1\0\1\0\0" + 1000 * "\0" + "\xff\xd9"
+
+
+# Generates a fake iPod in <root>, with <tracks> tracks in Artist/Album
+# folders. Every <disc_every>-th album is split into CD1/CD2 subfolders.
+# Returns a dictionary with some statistics.
+def make_ipod(root, tracks, album_size=12, frames=40, seconds=3,
+              mp4_ratio=0.1, ogg_ratio=0.0, id3v2_ratio=0.5, cover_ratio=0.3,
+              disc_every=7, seed=0):
+    rnd = random.Random(seed)
+    os.makedirs(os.path.join(root, "iPod_Control", "iTunes"))
+    f = open(os.path.join(root, "iPod_Control", "iTunes", "iTunesDB"), "wb")
+    f.write(iTunesDB.iTunesDB([], name="rePear benchmark", dbid=1).finish())
+    f.close()
+
+    streams = {}
+    for kind in ("cbr", "xing", "vbri"):
+        streams[kind] = mp3_stream(frames, kind)
+    cover = jpeg_file()
+    stats = { 'tracks': 0, 'bytes': 0, 'mp3': 0, 'mp4': 0, 'ogg': 0, 'covers': 0, 'playlists': 0 }
+    def write(path, data):
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        stats['bytes'] += len(data)
+
+    count = 0
+    album = 0
+    all_tracks = []
+    while count < tracks:
+        album += 1
+        artist = "Artist %d" % (1 + album // 4)
+        title = "Album %d" % album
+        adir = os.path.join(root, "Music", artist, title)
+        n = min(tracks - count, album_size)
+        if disc_every and not(album % disc_every):
+            dirs = [os.path.join(adir, "CD1"), os.path.join(adir, "CD2")]
+        else:
+            dirs = [adir]
+        for d in dirs:
+            os.makedirs(d)
+        names = []
+        for i in xrange(1, n + 1):
+            d = dirs[(i - 1) * len(dirs) / n]
+            name = "Track %d of %s" % (i, title)
+            r = rnd.random()
+            if r < mp4_ratio:
+                fn = "%02d - %s.m4a" % (i, name)
+                data = mp4_file(name, artist, title, i, seconds, (rnd.random() < cover_ratio) and cover)
+                stats['mp4'] += 1
+            elif r < (mp4_ratio + ogg_ratio):
+                fn = "%02d - %s.ogg" % (i, name)
+                data = ogg_file(name, artist, title, i, seconds, count + i)
+                stats['ogg'] += 1
+            else:
+                fn = "%02d - %s.mp3" % (i, name)
+                data = streams[rnd.choice(("cbr", "cbr", "xing", "vbri"))]
+                if rnd.random() < id3v2_ratio:
+                    data = id3v2([("TIT2", name), ("TPE1", artist), ("TALB", title),
+                                  ("TRCK", "%d/%d" % (i, n)), ("TYER", "2008")]) + data
+                data += id3v1(name, artist, title, 2008, i, rnd.randrange(0, 148))
+                stats['mp3'] += 1
+            write(os.path.join(d, fn), data)
+            names.append(os.path.join(d, fn)[len(adir) + 1:].replace(os.sep, "/"))
+            all_tracks.append(os.path.join(d, fn)[len(root) + 1:].replace(os.sep, "/"))
+        write(os.path.join(adir, "%s.m3u" % title), "\n".join(names) + "\n")
+        stats['playlists'] += 1
+        if rnd.random() < cover_ratio:
+            write(os.path.join(adir, "cover.jpg"), cover)
+            stats['covers'] += 1
+        count += n
+    stats['tracks'] = count
+
+    # a playlist that spans multiple albums, and a master playlist file
+    sample = rnd.sample(all_tracks, min(len(all_tracks), 500))
+    write(os.path.join(root, "Mix.m3u"), "\n".join(sample) + "\n")
+    stats['playlists'] += 1
+    write(os.path.join(root, "repear_playlists.ini"),
+          "[Balanced]\ninclude = /Music\nshuffle = 1\nseed = 1\n" \
+          "[Sorted]\ninclude = /Music\nsort = artist, album, track number\n" \
+          "[New]\nnew = 1\n")
+    return stats
+
+
+# Runs a rePear action on <root> in a separate process and returns a
+# dictionary with the wall-clock and CPU times and the phase timings.
+def run_repear(root, action, logfile, args=[]):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "repear.py")
+    cmd = [sys.executable, script, "-r", root, "-f", "-l", logfile] + args + [action]
+    t0 = time.time()
+    c0 = os.times()
+    out = open(os.devnull, "w")
+    try:
+        code = subprocess.call(cmd, stdout=out, stderr=subprocess.STDOUT)
+    finally:
+        out.close()
+    c1 = os.times()
+    res = { 'action': action, 'returncode': code,
+            'wall': time.time() - t0,
+            'cpu': (c1[2] - c0[2]) + (c1[3] - c0[3]) }
+
+    # include rePear's own phase timing report, if possible
+    if timing.json:
+        try:
+            f = open(os.path.splitext(logfile)[0] + ".timing.json")
+            res['phases'] = timing.json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            pass
+    return res
+
+
+################################################################################
+## the benchmarks                                                             ##
+################################################################################
+
+@benchmark
+def bench_shuffle(opts):
+    paths = make_library(50000)
+    def run(seed):
+        shuffle = repear.BalancedShuffle(seed)
+        for path in paths:
+            shuffle.add(path, path)
+        return shuffle.shuffle()
+    t, res = timed(run, 1)
+    assert len(res) == len(paths)
+    report("balanced shuffle, 50k tracks", t, len(paths))
+    t, res2 = timed(run, 1)
+    report("balanced shuffle, same seed", t, len(paths))
+    if res != res2:
+        print "WARNING: balanced shuffle is not reproducible"
+    results['shuffle'] = { 'tracks': len(paths), 'seconds': t }
+
+
+# track cache entries as the freeze action would produce them
+def make_tracklist(paths, seed=0):
+    rnd = random.Random(seed)
+    tracklist = []
+    for path in paths:
+        artist, album, title = path.split(u"/")[1:]
+        tracklist.append({
+            'id': len(tracklist) + 100, 'dbid': rnd.randrange(0L, 1L << 64),
+            'path': u"iPod_Control/" + path, 'title': title[5:-4], 'artist': artist,
+            'album': album, 'genre': u"Genre %d" % rnd.randrange(20),
+            'track number': int(title[:2]), 'format': "mp3-cbr", 'filetype': u"MPEG audio file",
+            'size': rnd.randrange(1L << 24), 'length': rnd.random() * 400, 'bitrate': 128,
+            'sample rate': 44100, 'play count': rnd.randrange(3), 'mtime': 1200000000
+        })
+    return tracklist
+
+@benchmark
+def bench_records(opts):
+    tracklist = make_tracklist(make_library(100000))
+    rnd = random.Random(1)
+    playlists = [rnd.sample(tracklist, len(tracklist) / 4) for i in xrange(20)]
+    def run(jobs):
+        db = iTunesDB.iTunesDB(tracklist, name="benchmark", dbid=1, jobs=jobs)
+        for i in xrange(len(playlists)):
+            db.add_playlist(playlists[i], "Playlist %d" % i)
+        return db.finish()
+    items = len(tracklist) + sum(map(len, playlists))
+    results['records'] = { 'tracks': len(tracklist), 'playlists': len(playlists),
+                           'entries': items, 'runs': [] }
+    reference = None
+    for jobs in [int(x) for x in opts.jobs.split(',')]:
+        t, data = timed(run, jobs)
+        report("iTunesDB, 100k x 20, %d job(s)" % jobs, t, items)
+        results['records']['runs'].append({ 'jobs': jobs, 'bytes': len(data), 'seconds': t })
+        # all IDs are stable, so the whole database must be identical
+        if reference is None:
+            reference = data
+        elif data != reference:
+            print "WARNING: the iTunesDB built with %d jobs is different" % jobs
+
+
+# the string-based iTunesSD writer of rePear 0.4.1, for comparison
+def legacy_sd_entry(info):
+    path = info['path']
+    if type(path) != types.UnicodeType:
+        path = unicode(path, sys.getfilesystemencoding(), 'replace')
+    path = u'/' + path
+    return "\0\x02\x2E\x5A\xA5\x01" + (20*"\0") + \
+           "\x64\0\0%c\0\x02\0" % (iTunesDB.SD_type_map.get(info.get('type', None), 1)) + \
+           path.encode("utf_16_le", 'replace') + \
+           ((261 - len(path)) * 2) * "\0" + \
+           "%c%c\0" % (info.get('shuffle flag', 1), info.get('bookmark flag', 0))
+
+def legacy_itunessd(tracklist):
+    return iTunesDB.be3(len(tracklist)) + "\x01\x06\0\0\0\x12" + (9*"\0") + \
+           "".join(map(legacy_sd_entry, tracklist))
+
+@benchmark
+def bench_itunessd(opts):
+    tracklist = make_tracklist(make_library(100000))
+    for i in xrange(0, len(tracklist), 3):
+        tracklist[i]['type'] = "aac"
+        tracklist[i]['shuffle flag'] = 0
+    t_old, old = timed(legacy_itunessd, tracklist)
+    report("iTunesSD, 100k, legacy", t_old, len(tracklist))
+    t_new, new = timed(iTunesDB.iTunesSD, tracklist)
+    report("iTunesSD, 100k, buffered", t_new, len(tracklist))
+    if new != old:
+        print "WARNING: the buffered iTunesSD writer produces different output"
+    # streaming the file in blocks, as the freeze action does
+    fd, filename = tempfile.mkstemp(prefix="repear-bench-")
+    os.close(fd)
+    try:
+        def write():
+            f = open(filename, "wb")
+            iTunesDB.WriteiTunesSD(f, tracklist)
+            f.close()
+        t_write, dummy = timed(write)
+        report("iTunesSD, 100k, streamed to disk", t_write, len(tracklist))
+    finally:
+        os.remove(filename)
+    results['itunessd'] = { 'tracks': len(tracklist), 'bytes': len(new), 'identical': new == old,
+                            'legacy': t_old, 'buffered': t_new, 'streamed': t_write }
+
+
+scenarios = { '10k': 10000, '50k': 50000, '100k': 100000 }
+
+@benchmark
+def bench_freeze(opts):
+    repear_args = []
+    if opts.model:
+        repear_args = ["-m", opts.model]
+    for scenario in opts.scenarios or ['10k']:
+        try:
+            tracks = scenarios[scenario]
+        except KeyError:
+            tracks = int(scenario)
+        root = tempfile.mkdtemp(prefix="repear-bench-")
+        try:
+            t, stats = timed(make_ipod, root, tracks)
+            report("generate %s" % scenario, t, stats['tracks'])
+            res = { 'tracks': tracks, 'generate': t, 'tree': stats, 'actions': [] }
+            for action in opts.actions.split(','):
+                logfile = os.path.join(root, "repear-%s-%d.log" % (action, len(res['actions'])))
+                run = run_repear(root, action, logfile, repear_args)
+                res['actions'].append(run)
+                report("%s %s" % (action, scenario), run['wall'], tracks)
+                if run['returncode']:
+                    print "WARNING: %s failed with exit code %d, see %s" % (action, run['returncode'], logfile)
+                    opts.keep = True
+            results['freeze-' + scenario] = res
+        finally:
+            if opts.keep:
+                print "generated iPod kept in", root
+            else:
+                shutil.rmtree(root, True)
+
+
+def write_report(filename):
+    f = open(filename, "w")
+    timing.dump_json(results, f)
+    f.close()
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] [<benchmark>...]",
+             epilog="benchmarks: " + ", ".join([name for name, func in benchmarks]))
+    parser.add_option("-s", "--scenario", action="append", dest="scenarios", default=[], metavar="SIZE",
+                      help="freeze benchmark library size (%s or a track count; may be repeated)" % ", ".join(scenarios))
+    parser.add_option("-a", "--actions", action="store", default="freeze,update,unfreeze", metavar="LIST",
+                      help="comma-separated rePear actions to run (default: %default)")
+    parser.add_option("-m", "--model", action="store", default=None, metavar="MODEL",
+                      help="iPod model to pass to rePear (enables artwork)")
+    parser.add_option("-j", "--jobs", action="store", default="1", metavar="LIST",
+                      help="comma-separated worker process counts for the records benchmark (default: %default)")
+    parser.add_option("-o", "--report", action="store", default="benchmark.json", metavar="FILE",
+                      help="write a JSON report to FILE (default: %default)")
+    parser.add_option("-k", "--keep", action="store_true", default=False,
+                      help="don't delete the generated iPod trees")
+    (opts, names) = parser.parse_args()
+    for name, func in benchmarks:
+        if not(names) or (name in names):
+            func(opts)
+    write_report(opts.report)
+    print "report written to", opts.report
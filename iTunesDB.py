@@ -17,7 +17,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import struct, random, types, array, sys, os, stat, time
+import struct, random, types, array, sys, os, stat, time, cStringIO, md5
+import timing
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 try:
     import Image, JpegImagePlugin, PngImagePlugin
     PILAvailable = True
@@ -25,7 +30,10 @@ except ImportError:
     PILAvailable = False
 
 
-def DefaultLoggingFunction(text, force_flush=True):
+# log levels (same as repear.LOG_*)
+LOG_ERROR, LOG_WARNING, LOG_INFO, LOG_DETAIL = range(4)
+
+def DefaultLoggingFunction(text, force_flush=True, level=LOG_INFO):
     sys.stdout.write(text)
     if force_flush:
         sys.stdout.flush()
@@ -88,12 +96,15 @@ class Record:
         if self.header_length_at:
             data = data[:self.header_length_at] + struct.pack("<L", len(data)) + data[self.header_length_at+4:]
         self.data = data
+        self.children = []
         self.child_count = 0
     def add(self, obj, count=1):
+        # children are only joined once in __str__, appending them to the
+        # data string one by one would take quadratic time
         self.child_count += count
-        self.data += str(obj)
+        self.children.append(str(obj))
     def __str__(self):
-        data = self.data
+        data = self.data + "".join(self.children)
         if self.total_length_at:
             data = data[:self.total_length_at] + struct.pack("<L", len(data)) + data[self.total_length_at+4:]
         if self.child_count_at:
@@ -115,14 +126,6 @@ def make_compare_key(x):
         return x
 
 
-def compare_dict(a, b, fields):
-    for field in fields:
-        res = cmp(make_compare_key(a.get(field,None)), \
-                  make_compare_key(b.get(field,None)))
-        if res: return res
-    return 0
-
-
 def ifelse(condition, then_val, else_val=None):
     if condition: return then_val
     else: return else_val
@@ -171,6 +174,48 @@ class StringDataObject(Record):
         self.add(content)
 
 
+# Most string mhods (artist, album, genre, file type) repeat the same few
+# values over and over, so the serialized records are cached. When the cache
+# is full, it's simply emptied; this is cheaper than a real LRU scheme and
+# works just as well for the typical runs of tracks from the same album.
+class StringCache:
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, record_class, mhod_type, content):
+        key = (record_class, mhod_type, content)
+        try:
+            data = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            if len(self.entries) >= self.size:
+                self.entries.clear()
+            data = self.entries[key] = str(record_class(mhod_type, content))
+            return data
+        self.hits += 1
+        return data
+
+    # add the counts of another process' cache
+    def merge(self, hits, misses):
+        self.hits += hits
+        self.misses += misses
+
+    # add the hit and miss counts to the timing report
+    def publish(self):
+        timing.timer.count("mhod cache hits", self.hits)
+        timing.timer.count("mhod cache misses", self.misses)
+        self.hits = self.misses = 0
+
+# the cache shared by the iTunesDB and ArtworkDB writers
+string_cache = StringCache()
+
+# the mhod types that are worth caching (titles and paths are unique anyway)
+CACHED_MHOD_TYPES = (3, 4, 5, 6)
+
+
 class OrderDataObject(Record):
     def __init__(self, order):
         Record.__init__(self, (
@@ -184,6 +229,17 @@ class OrderDataObject(Record):
         ))
 
 
+# the complete mhit header, packed with a single call
+MHIT_HEADER = struct.Struct("<" +
+    "4sLLLLL4sHBB" +    # tag, lengths, child count, ID, visible, file type, compilation, rating
+    "LLLLLLLHH" +       # mtime, size, length, track, total tracks, year, bitrate, sample rate
+    "LLLLLLL" +         # volume, start/stop time, soundcheck, play count, last played
+    "LLLLLQ" +          # disc, total discs, user ID, date added, bookmark, dbid
+    "BBHHHLLfLHH8x" +   # checked, ratings, BPM, artwork, media format, sample rate, release date
+    "LLBBBBQBBB9x" +    # skip count, last skipped, flags, dbid, more flags
+    "L16xLLL28x" +      # sample count, media type, season, episode
+    "LLHH20x18xH52xL")  # gapless data, album ID, mhii link
+
 class TrackItemRecord(Record):
     def __init__(self, info):
         if not 'id' in info:
@@ -199,101 +255,109 @@ class TrackItemRecord(Record):
             media_type = 2
         else:
             media_type = 1
-        Record.__init__(self, (
-            F_Tag("mhit"),
-            F_HeaderLength(),
-            F_TotalLength(),
-            F_ChildCount(),
-            F_Int32(info.get('id', 0)),                                   # !!!
-            F_Int32(info.get('visible', 1)), # visible
-            F_Tag({"mp3": " 3PM", "aac": " CAA", "mp4a": "A4PM"}.get(format[:3], "\0\0\0\0")),
-            F_Int16({"mp3-cbr": 0x100, "mp3-vbr": 0x101, "aac": 0, "mp4a": 0}.get(format, 0)),
-            F_Int8(info.get('compilation', 0)),
-            F_Int8(info.get('rating', 0)),
-            F_Int32(unixtime2mactime(info.get('mtime', 0))),
-            F_Int32(info.get('size', 0)),                                 # !!!
-            F_Int32(int(info.get('length', 0) * 1000)),                   # !!!
-            F_Int32(info.get('track number', 0)),
-            F_Int32(info.get('total tracks', 0)),
-            F_Int32(info.get('year', 0)),
-            F_Int32(info.get('bitrate', 0)),                              # !!!
-            F_Int16(0),
-            F_Int16(info.get('sample rate', 0)),                          # !!!
-            F_Int32(info.get('volume', 0)),
-            F_Int32(info.get('start time', 0)),
-            F_Int32(info.get('stop time', 0)),
-            F_Int32(info.get('soundcheck', 0)),
-            F_Int32(info.get('play count', 0)),
-            F_Int32(0),
-            F_Int32(unixtime2mactime(info.get('last played time', 0))),
-            F_Int32(info.get('disc number', 0)),
-            F_Int32(info.get('total discs', 0)),
-            F_Int32(info.get('user id', 0)),
-            F_Int32(info.get('date added', 0)),
-            F_Int32(int(info.get('bookmark time', 0) * 1000)),
-            F_Int64(info.get('dbid', 0)),                                 # !!!
-            F_Int8(info.get('checked', 0)),
-            F_Int8(info.get('application rating', 0)),
-            F_Int16(info.get('BPM', 0)),
-            F_Int16(info.get('artwork count', 1)),
-            F_Int16({"wave": 0, "audible": 1}.get(format, 0xFFFF)),
-            F_Int32(info.get('artwork size', default_artwork_size)),
-            F_Int32(0),
-            F_Formatable("f", info.get('sample rate', 0)),
-            F_Int32(info.get('release date', 0)),
-            F_Int16({"aac": 0x0033, "mp4a": 0x0033, "audible": 0x0029, "wave:": 0}.get(format, 0x0C)),
-            F_Int16(info.get('explicit flag', 0)),
-            F_Padding(8),
-            F_Int32(info.get('skip count', 0)),
-            F_Int32(unixtime2mactime(info.get('last skipped time', 0))),
-            F_Int8(2 - int(info.get('has artwork', default_has_artwork))),
-            F_Int8(not info.get('shuffle flag', 1)),
-            F_Int8(info.get('bookmark flag', 0)),
-            F_Int8(info.get('podcast flag', 0)),
-            F_Int64(info.get('dbid', 0)),
-            F_Int8(info.get('lyrics flag', 0)),
-            F_Int8(info.get('movie flag', 0)),
-            F_Int8(info.get('played mark', 1)),
-            F_Padding(9),
-            F_Int32(ifelse(format[:3]=="mp3", 0, info.get('sample count', 0))),
-            F_Padding(16),
-            F_Int32(media_type),
-            F_Int32(0), # season number
-            F_Int32(0), # episode number
-            F_Padding(28),
-            F_Int32(info.get('gapless data', 0)),
-            F_Int32(0),
-            F_Int16(info.get('gapless track flag', 0)),
-            F_Int16(info.get('gapless album flag', 0)),
-            F_Padding(20), # hash
-            F_Padding(18), # misc unknowns
-            F_Int16(info.get('album id', 0)),
-            F_Padding(52), # padding before mhii link
-            F_Int32(info.get('mhii link', 0))
-        ))
+        mhods = []
         for mhod_type, key in ((1,'title'), (4,'artist'), (3,'album'), (5,'genre'), (6,'filetype'), (2,'path')):
             if key in info:
                 value = info[key]
                 if key=="path":
                     value = ":" + value.replace("/", ":").replace("\\", ":")
-                self.add(StringDataObject(mhod_type, value))
-
+                if mhod_type in CACHED_MHOD_TYPES:
+                    mhods.append(string_cache(StringDataObject, mhod_type, value))
+                else:
+                    mhods.append(str(StringDataObject(mhod_type, value)))
+        self.header_length_at = None
+        self.total_length_at = None
+        self.child_count_at = None
+        self.children = []
+        self.child_count = len(mhods)
+        mhods = "".join(mhods)
+        self.data = MHIT_HEADER.pack(
+            "mhit",
+            MHIT_HEADER.size,
+            MHIT_HEADER.size + len(mhods),
+            self.child_count,
+            info.get('id', 0),                                      # !!!
+            info.get('visible', 1), # visible
+            {"mp3": " 3PM", "aac": " CAA", "mp4a": "A4PM"}.get(format[:3], "\0\0\0\0"),
+            {"mp3-cbr": 0x100, "mp3-vbr": 0x101, "aac": 0, "mp4a": 0}.get(format, 0),
+            info.get('compilation', 0),
+            info.get('rating', 0),
+            unixtime2mactime(info.get('mtime', 0)),
+            info.get('size', 0),                                    # !!!
+            int(info.get('length', 0) * 1000),                      # !!!
+            info.get('track number', 0),
+            info.get('total tracks', 0),
+            info.get('year', 0),
+            info.get('bitrate', 0),                                 # !!!
+            0,
+            info.get('sample rate', 0),                             # !!!
+            info.get('volume', 0),
+            info.get('start time', 0),
+            info.get('stop time', 0),
+            info.get('soundcheck', 0),
+            info.get('play count', 0),
+            0,
+            unixtime2mactime(info.get('last played time', 0)),
+            info.get('disc number', 0),
+            info.get('total discs', 0),
+            info.get('user id', 0),
+            info.get('date added', 0),
+            int(info.get('bookmark time', 0) * 1000),
+            info.get('dbid', 0),                                    # !!!
+            info.get('checked', 0),
+            info.get('application rating', 0),
+            info.get('BPM', 0),
+            info.get('artwork count', 1),
+            {"wave": 0, "audible": 1}.get(format, 0xFFFF),
+            info.get('artwork size', default_artwork_size),
+            0,
+            info.get('sample rate', 0),
+            info.get('release date', 0),
+            {"aac": 0x0033, "mp4a": 0x0033, "audible": 0x0029, "wave:": 0}.get(format, 0x0C),
+            info.get('explicit flag', 0),
+            info.get('skip count', 0),
+            unixtime2mactime(info.get('last skipped time', 0)),
+            2 - int(info.get('has artwork', default_has_artwork)),
+            not info.get('shuffle flag', 1),
+            info.get('bookmark flag', 0),
+            info.get('podcast flag', 0),
+            info.get('dbid', 0),
+            info.get('lyrics flag', 0),
+            info.get('movie flag', 0),
+            info.get('played mark', 1),
+            ifelse(format[:3]=="mp3", 0, info.get('sample count', 0)),
+            media_type,
+            0, # season number
+            0, # episode number
+            info.get('gapless data', 0),
+            0,
+            info.get('gapless track flag', 0),
+            info.get('gapless album flag', 0),
+            info.get('album id', 0),
+            info.get('mhii link', 0)
+        ) + mhods
+
+
+# a mhip record together with its order mhod, packed with a single call
+MHIP_RECORD = struct.Struct("<4sLLLLLLLL40x" + "4sLLL8xL16x")
+MHIP_HEADER_SIZE = 76
 
 class PlaylistItemRecord(Record):
     def __init__(self, order, trackid, timestamp=0):
-        Record.__init__(self, (
-            F_Tag("mhip"),
-            F_HeaderLength(),
-            F_TotalLength(),
-            F_ChildCount(),
-            F_Int32(0),
-            F_Int32((trackid + 0x1337) & 0xFFFF),
-            F_Int32(trackid),
-            F_Int32(timestamp),
-            F_Int32(0),
-            F_Padding(40)
-        ))
-        self.add(OrderDataObject(order))
+        self.header_length_at = None
+        self.total_length_at = None
+        self.child_count_at = None
+        self.children = []
+        self.child_count = 1
+        self.data = pack_playlist_item(order, trackid, timestamp)
+
+def pack_playlist_item(order, trackid, timestamp=0, buf=None, offset=0):
+    values = ("mhip", MHIP_HEADER_SIZE, MHIP_RECORD.size, 1,
+              0, (trackid + 0x1337) & 0xFFFF, trackid, timestamp, 0,
+              "mhod", 0x18, 0x2C, 100, order)
+    if buf is None:
+        return MHIP_RECORD.pack(*values)
+    MHIP_RECORD.pack_into(buf, offset, *values)
 
 
 class PlaylistRecord(Record):
@@ -317,9 +381,10 @@ class PlaylistRecord(Record):
         self.add(StringDataObject(1, name))
         self.add(OrderDataObject(order))
 
-    def add_index(self, tracklist, index_type, fields):
-        order = range(len(tracklist))
-        order.sort(lambda a,b: compare_dict(tracklist[a], tracklist[b], fields))
+    def add_index(self, columns, index_type, fields):
+        keys = zip(*[columns[field] for field in fields])
+        order = range(len(keys))
+        order.sort(key=keys.__getitem__)
         mhod = Record((
             F_Tag("mhod"),
             F_Int32(24),
@@ -340,8 +405,14 @@ class PlaylistRecord(Record):
         self.add(mhod)
 
     def set_playlist(self, track_ids):
+        # all mhip records are packed into one preallocated buffer
+        size = MHIP_RECORD.size
+        buf = array.array('c', len(track_ids) * size * "\0")
+        offset = 0
         for i in xrange(len(track_ids)):
-            self.add(PlaylistItemRecord(i+1, track_ids[i]), 0)
+            pack_playlist_item(i+1, track_ids[i], 0, buf, offset)
+            offset += size
+        self.add(buf.tostring(), 0)
 
 
 
@@ -349,8 +420,26 @@ class PlaylistRecord(Record):
 ## the toplevel ITDB class                                                    ##
 ################################################################################
 
+# serialize a chunk of the track list (runs in a worker process); the string
+# cache counts of the chunk are returned along with the records, because the
+# worker's own counters never make it into the timing report
+def serialize_tracks(tracklist):
+    hits, misses = string_cache.hits, string_cache.misses
+    data = "".join([str(TrackItemRecord(track)) for track in tracklist])
+    return (data, string_cache.hits - hits, string_cache.misses - misses)
+
+# number of chunks per worker process, to even out the workload
+CHUNKS_PER_JOB = 4
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError):
+        return 1
+
+
 class iTunesDB:
-    def __init__(self, tracklist, name="Unnamed", dbid=None, dbversion=0x19):
+    def __init__(self, tracklist, name="Unnamed", dbid=None, dbversion=0x19, jobs=1):
         if not dbid: dbid = random.randrange(0L, 18446744073709551615L)
 
         self.mhbd = Record((
@@ -371,66 +460,232 @@ class iTunesDB:
             F_Padding(80)
         ))
 
-        self.mhsd = Record((
+        # the track records are only serialized in finish(), so that update
+        # runs that end up patching the old database don't pay for them;
+        # with multiple jobs, worker processes start on them right away, in
+        # parallel to the master index sorting below
+        self.tracklist = tracklist
+        self.pool = None
+        self.chunks = None
+        if (jobs > 1) and multiprocessing and (len(tracklist) > jobs):
+            try:
+                self.pool = multiprocessing.Pool(jobs)
+            except (OSError, ImportError, NotImplementedError), e:
+                log("WARNING: can't start worker processes (%s), using only one.\n" % e, True, LOG_WARNING)
+            if self.pool:
+                chunk_size = (len(tracklist) + jobs * CHUNKS_PER_JOB - 1) / (jobs * CHUNKS_PER_JOB)
+                chunks = [tracklist[i:i+chunk_size] for i in xrange(0, len(tracklist), chunk_size)]
+                self.chunks = self.pool.map_async(serialize_tracks, chunks)
+                self.pool.close()
+        self.mhlp = Record((
+            F_Tag("mhlp"),
+            F_HeaderLength(),
+            F_ChildCount(),
+            F_Padding(80)
+        ))
+
+        # the normalized sort columns are shared by all the master indices
+        timing.timer.begin("master indices")
+        columns = {}
+        for field in ('title', 'album', 'artist', 'genre', 'composer', 'disc number', 'track number'):
+            columns[field] = [make_compare_key(track.get(field, None)) for track in tracklist]
+
+        self.plids = {}
+        mhyp = PlaylistRecord(name, len(tracklist), master=1, sort_order=10,
+                              plid=stable_id(name, self.plids))
+        mhyp.add_index(columns, 0x03, ('title',))
+        mhyp.add_index(columns, 0x04, ('album','disc number','track number','title'))
+        mhyp.add_index(columns, 0x05, ('artist','album','disc number','track number','title'))
+        mhyp.add_index(columns, 0x07, ('genre','artist','album','disc number','track number','title'))
+        mhyp.add_index(columns, 0x12, ('composer','title'))
+        mhyp.set_playlist([track['id'] for track in tracklist])
+        self.mhlp.add(mhyp)
+        timing.timer.end()
+
+    def add_playlist(self, tracks, name="Unnamed"):
+        mhyp = PlaylistRecord(name, len(tracks), sort_order=1,
+                              plid=stable_id(name, self.plids))
+        mhyp.set_playlist([track['id'] for track in tracks])
+        self.mhlp.add(mhyp)
+
+    def track_section(self):
+        mhsd = Record((
             F_Tag("mhsd"),
             F_HeaderLength(),
             F_TotalLength(),
             F_Int32(1),
             F_Padding(80)
         ))
-        self.mhlt = Record((
+        mhlt = Record((
             F_Tag("mhlt"),
             F_HeaderLength(),
             F_ChildCount(),
             F_Padding(80)
         ))
-
-        for track in tracklist:
-            self.mhlt.add(TrackItemRecord(track))
-
-        self.mhsd.add(self.mhlt)
-        del self.mhlt
-        self.mhbd.add(self.mhsd)
-
-        self.mhsd = Record((
+        timing.timer.begin("track records")
+        if self.chunks:
+            # the chunks are returned in order, and their child counts add up;
+            # get() needs a timeout to be interruptible by Ctrl+C
+            for chunk, hits, misses in self.chunks.get(86400):
+                mhlt.add(chunk, 0)
+                string_cache.merge(hits, misses)
+            mhlt.child_count = len(self.tracklist)
+            self.close()
+        else:
+            for track in self.tracklist:
+                mhlt.add(TrackItemRecord(track))
+        timing.timer.end(len(self.tracklist))
+        string_cache.publish()
+        mhsd.add(mhlt)
+        return str(mhsd)
+
+    def playlist_section(self):
+        mhsd = Record((
             F_Tag("mhsd"),
             F_HeaderLength(),
             F_TotalLength(),
             F_Int32(2),
             F_Padding(80)
         ))
-        self.mhlp = Record((
-            F_Tag("mhlp"),
-            F_HeaderLength(),
-            F_ChildCount(),
-            F_Padding(80)
-        ))
+        mhsd.add(self.mhlp)
+        return str(mhsd)
 
-        mhyp = PlaylistRecord(name, len(tracklist), master=1, sort_order=10)
-        mhyp.add_index(tracklist, 0x03, ('title',))
-        mhyp.add_index(tracklist, 0x04, ('album','disc number','track number','title'))
-        mhyp.add_index(tracklist, 0x05, ('artist','album','disc number','track number','title'))
-        mhyp.add_index(tracklist, 0x07, ('genre','artist','album','disc number','track number','title'))
-        mhyp.add_index(tracklist, 0x12, ('composer','title'))
-        mhyp.set_playlist([track['id'] for track in tracklist])
-        self.mhlp.add(mhyp)
-
-    def add_playlist(self, tracks, name="Unnamed"):
-        mhyp = PlaylistRecord(name, len(tracks), sort_order=1)
-        mhyp.set_playlist([track['id'] for track in tracks])
-        self.mhlp.add(mhyp)
+    # stop the worker processes, if the database isn't going to be finished
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.chunks = None
 
     def finish(self):
-        self.mhsd.add(self.mhlp)
+        self.mhbd.add(self.track_section())
+        self.mhbd.add(self.playlist_section())
+        del self.tracklist
         del self.mhlp
-        self.mhbd.add(self.mhsd)
-        del self.mhsd
         result = str(self.mhbd)
         del self.mhbd
         return result
 
 
 
+################################################################################
+## in-place update of the play statistics in an existing iTunesDB             ##
+################################################################################
+
+# the fixed-width fields that may be changed by a play counts import, given
+# as (offset into the mhit header, struct format, value function)
+PLAY_STATISTICS_FIELDS = (
+    ( 31, "<B", lambda info: info.get('rating', 0)),
+    ( 80, "<L", lambda info: info.get('play count', 0)),
+    ( 88, "<L", lambda info: unixtime2mactime(info.get('last played time', 0))),
+    (108, "<L", lambda info: int(info.get('bookmark time', 0) * 1000)),
+    (156, "<L", lambda info: info.get('skip count', 0)),
+    (160, "<L", lambda info: unixtime2mactime(info.get('last skipped time', 0))),
+)
+
+# databases written by older rePear versions have random playlist IDs
+PLAYLIST_ID_OFFSET = 28
+
+
+class DatabaseLayout:
+    def __init__(self, data):
+        if data[:4] != "mhbd":
+            raise ValueError, "not an iTunesDB file"
+        self.data = data
+        self.sections = {}
+        pos = struct.unpack("<L", data[4:8])[0]
+        while pos < len(data):
+            tag, hlen, tlen, kind = struct.unpack("<4sLLL", data[pos:pos+16])
+            if (tag != "mhsd") or (tlen < hlen) or (hlen < 16):
+                raise ValueError, "invalid mhsd record at offset %d" % pos
+            self.sections[kind] = (pos, pos + tlen)
+            pos += tlen
+
+    def section(self, kind):
+        start, end = self.sections[kind]
+        return self.data[start:end]
+
+    # returns a list of (offset, track id, dbid, size) for each mhit
+    def track_index(self):
+        start, end = self.sections[1]
+        pos = start + struct.unpack("<L", self.data[start+4:start+8])[0]
+        if self.data[pos:pos+4] != "mhlt":
+            raise ValueError, "mhlt record not found"
+        count = struct.unpack("<L", self.data[pos+8:pos+12])[0]
+        pos += struct.unpack("<L", self.data[pos+4:pos+8])[0]
+        index = []
+        for i in xrange(count):
+            tag, hlen, tlen, children, trackid = struct.unpack("<4sLLLL", self.data[pos:pos+20])
+            if (tag != "mhit") or (hlen < 164) or (pos + tlen > end):
+                raise ValueError, "invalid mhit record at offset %d" % pos
+            size = struct.unpack("<L", self.data[pos+36:pos+40])[0]
+            dbid = struct.unpack("<Q", self.data[pos+112:pos+120])[0]
+            index.append((pos, trackid, dbid, size))
+            pos += tlen
+        return index
+
+
+# blank out the playlist IDs in a playlist section, so that two sections
+# can be compared for everything else
+def mask_playlist_ids(section):
+    parts = []
+    pos = struct.unpack("<L", section[4:8])[0]
+    parts.append(section[:pos])
+    if section[pos:pos+4] != "mhlp":
+        return section
+    count = struct.unpack("<L", section[pos+8:pos+12])[0]
+    hlen = struct.unpack("<L", section[pos+4:pos+8])[0]
+    parts.append(section[pos:pos+hlen])
+    pos += hlen
+    for i in xrange(count):
+        if section[pos:pos+4] != "mhyp":
+            break
+        tlen = struct.unpack("<L", section[pos+8:pos+12])[0]
+        parts.append(section[pos:pos+PLAYLIST_ID_OFFSET])
+        parts.append(8 * "\0")
+        parts.append(section[pos+PLAYLIST_ID_OFFSET+8:pos+tlen])
+        pos += tlen
+    parts.append(section[pos:])
+    return "".join(parts)
+
+
+# Apply the play statistics of a track list to an existing database. The
+# track list must describe exactly the tracks in the database, in the same
+# order, and the playlist section must match the existing one (apart from
+# the playlist IDs). Returns the patched database and the number of
+# changed tracks, or (None, reason) if a full rebuild is required.
+def PatchPlayStatistics(data, tracklist, playlist_section):
+    try:
+        layout = DatabaseLayout(data)
+        index = layout.track_index()
+        old_playlists = layout.section(2)
+    except (ValueError, KeyError, struct.error), e:
+        return (None, "can't parse old database (%s)" % e)
+    if len(index) != len(tracklist):
+        return (None, "number of tracks changed")
+    for (pos, trackid, dbid, size), info in zip(index, tracklist):
+        if (trackid != info.get('id', 0)) or (dbid != info.get('dbid', 0)) \
+        or (size != info.get('size', 0)):
+            return (None, "track list changed")
+    if mask_playlist_ids(old_playlists) != mask_playlist_ids(playlist_section):
+        return (None, "playlists changed")
+
+    data = array.array('c', data)
+    changed = 0
+    for (pos, trackid, dbid, size), info in zip(index, tracklist):
+        dirty = False
+        for offset, format, value in PLAY_STATISTICS_FIELDS:
+            offset += pos
+            new = struct.pack(format, value(info))
+            if data[offset:offset+len(new)].tostring() != new:
+                data[offset:offset+len(new)] = array.array('c', new)
+                dirty = True
+        if dirty:
+            changed += 1
+    return (data.tostring(), changed)
+
+
 ################################################################################
 ## ArtworkDB / PhotoDB record classes                                         ##
 ################################################################################
@@ -474,11 +729,17 @@ class ImageInfo:
     pass
 
 class ArtworkFormat:
-    def __init__(self, descriptor, cache_info=(0,0)):
+    def __init__(self, descriptor, cache_info=(0,0), output_dir=None):
         self.fid, self.height, self.width, self.format = descriptor
         self.filename = "F%04d_1.ithmb" % self.fid
         self.size = self.width * self.height * self.format.bpp/8
         self.fullname = "iPod_Control/Artwork/" + self.filename
+        # the new file may be written to a different directory than the old
+        # one (which is only read as a cache)
+        if output_dir:
+            self.outname = os.path.join(output_dir, self.filename)
+        else:
+            self.outname = self.fullname
 
         # check if the cache file can be used
         try:
@@ -502,16 +763,16 @@ class ArtworkFormat:
 
         # open the destination file
         try:
-            self.f = open(self.fullname, "wb")
+            self.f = open(self.outname, "wb")
         except IOError, e:
-            log("WARNING: Error opening the artwork data file `%s'\n", self.filename)
+            log("WARNING: Error opening the artwork data file `%s'\n" % self.filename, True, LOG_WARNING)
             self.f = None
 
     def close(self):
         if self.f:
             self.f.close()
         try:
-            s = os.stat(self.fullname)
+            s = os.stat(self.outname)
             cache_info = (s[stat.ST_MTIME], s[stat.ST_SIZE])
         except OSError:
             cache_info = (0, 0)
@@ -526,7 +787,7 @@ class ArtworkFormat:
             mx = cache_entry['dim'][self.fid]['mx']
             my = cache_entry['dim'][self.fid]['my']
         else:
-            log(" [%dx%d]" % (self.width, self.height), True)
+            log(" [%dx%d]" % (self.width, self.height), False, LOG_DETAIL)
 
             # sx/sy = resulting image size
             sx = self.width
@@ -551,7 +812,7 @@ class ArtworkFormat:
             self.f.seek(self.size * index)
             self.f.write(data)
         except IOError:
-            log(" [WRITE ERROR]", True)
+            log(" [WRITE ERROR]", True, LOG_ERROR)
 
         # return image metadata
         iinfo = ImageInfo()
@@ -615,8 +876,7 @@ class ImageDataObject(Record):
             F_Padding(32)
         ))
 
-        mhod = ArtworkDBStringDataObject(3, ":" + iinfo.format.filename)
-        mhni.add(mhod)
+        mhni.add(string_cache(ArtworkDBStringDataObject, 3, ":" + iinfo.format.filename))
         self.add(mhni)
 
 
@@ -638,7 +898,7 @@ class ImageItemRecord(Record):
             self.add(ImageDataObject(iinfo))
 
 
-def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
+def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {}), output_dir=None):
     while type(ImageFormats.get(model, None)) == types.StringType:
         model = ImageFormats[model]
     if not model in ImageFormats:
@@ -648,7 +908,8 @@ def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
     formats = []
     for descriptor in ImageFormats[model]:
         formats.append(ArtworkFormat(descriptor,
-                       cache_info = format_cache.get(descriptor[0], (0,0))))
+                       cache_info = format_cache.get(descriptor[0], (0,0)),
+                       output_dir = output_dir))
         # if there's at least one format whose image file isn't cache-clean,
         # invalidate the cache
         if not formats[-1].cache:
@@ -675,13 +936,13 @@ def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
     image_count = 0
     dbid2mhii = {}
     for source, dbid_list in imagelist.iteritems():
-        log(source, False)
+        log(source, False, LOG_DETAIL)
 
         # stat this image
         try:
             s = os.stat(source)
         except OSError, e:
-            log(" [Error: %s]\n" % e.strerror, True)
+            log(" [Error: %s]\n" % e.strerror, True, LOG_ERROR)
             continue
 
         # check if the image is cacheworthy
@@ -692,15 +953,16 @@ def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
                 cache_entry = None
 
         # if it's not cached, open the image
+        t0 = time.time()
         if not cache_entry:
             try:
                 image = Image.open(source)
                 image.tostring()
             except IOError, e:
-                log(" [Error: %s]\n" % e, True)
+                log(" [Error: %s]\n" % e, True, LOG_ERROR)
                 continue
         else:
-            log(" [cached]", True)
+            log(" [cached]", False, LOG_DETAIL)
             image = None
 
         # generate the image data and ArtworkDB records
@@ -728,10 +990,11 @@ def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
         }
 
         # done with this image
+        timing.timer.measure("artwork image", time.time() - t0, source)
         del iinfo_list
         index += 1
         image_count += len(dbid_list)
-        log(" [OK]\n", True)
+        log(" [OK]\n", False, LOG_DETAIL)
 
     # Date File Header
     mhfd = Record((
@@ -798,6 +1061,7 @@ def ArtworkDB(model, imagelist, base_id=0x40, cache_data=({}, {})):
     mhsd.add(mhlf)
     mhfd.add(mhsd)
     output_format_cache = dict([format.close() for format in formats])
+    string_cache.publish()
     del formats
     output_cache_data = (output_format_cache, output_image_cache)
     return (str(mhfd), output_cache_data, dbid2mhii)
@@ -821,57 +1085,67 @@ mhod_type_map = {
 
 class InvalidFormat(Exception): pass
 
+# The database is read in one go and parsed from memory, which is a lot
+# faster than reading it record by record. With 'fields', only the given
+# string fields (e.g. ('path', 'title')) are decoded.
 class DatabaseReader:
-    def __init__(self, f="iPod_Control/iTunes/iTunesDB"):
+    def __init__(self, f="iPod_Control/iTunes/iTunesDB", fields=None):
         if type(f)==types.StringType:
             f = open(f, "rb")
         self.f = f
-        self._skip_header("mhbd")
+        self.data = data = f.read()
+        if fields is None:
+            self.types = mhod_type_map
+        else:
+            self.types = dict([(t, k) for t, k in mhod_type_map.iteritems() if k in fields])
+        self.pos = self._skip_header(0, "mhbd")
         while True:
-            h = self._skip_header("mhsd")
-            if len(h) < 16:
+            start = self.pos
+            self.pos = self._skip_header(start, "mhsd")
+            if self.pos - start < 16:
                 raise InvalidFormat
-            size, mhsd_type = struct.unpack('<LL', h[8:16])
+            size, mhsd_type = struct.unpack_from('<LL', data, start + 8)
             if mhsd_type == 1:
                 break  # found the mhlt entry -> yeah!
-            if size < len(h):
+            if size < self.pos - start:
                 raise InvalidFormat
-            self.f.seek(size - len(h), 1)
-        self._skip_header("mhlt")
+            self.pos = start + size
+        self.pos = self._skip_header(self.pos, "mhlt")
 
-    def _skip_header(self, tag):  # a little helper function
-        hh = self.f.read(8)
-        if (len(hh) != 8) or (hh[:4] != tag):
+    def _skip_header(self, pos, tag):  # a little helper function
+        if self.data[pos:pos+4] != tag:
             raise InvalidFormat
-        size = struct.unpack('<L', hh[4:])[0]
-        if size < 8:
+        size = struct.unpack_from('<L', self.data, pos + 4)[0]
+        if (size < 8) or (pos + size > len(self.data)):
             raise InvalidFormat
-        return hh + self.f.read(size - 8)
+        return pos + size
 
     def __iter__(self): return self
     def next(self):
+        data = self.data
+        start = self.pos
         try:
-            header = self._skip_header("mhit")
-        except (IOError, InvalidFormat):
+            pos = self._skip_header(start, "mhit")
+        except (InvalidFormat, struct.error):
             raise StopIteration
-        data_size = struct.unpack('<L', header[8:12])[0] - len(header)
-        if data_size<0:
+        end = start + struct.unpack_from('<L', data, start + 8)[0]
+        if (end < pos) or (end - pos < 48) or (end > len(data)):
             raise InvalidFormat
+        self.pos = end
 
         info = {}
-        data = self.f.read(data_size)
-        if len(data) < 48:
-            raise InvalidFormat
-        trk = struct.unpack('<L', header[44:48])[0]
+        trk = struct.unpack_from('<L', data, start + 44)[0]
         if trk: info['track number'] = trk
 
         # walk through mhods
-        while (len(data) > 40) and (data[:4] == "mhod"):
-            size, mhod_type = struct.unpack('<LL', data[8:16])
-            value = unicode(data[40:size], "utf_16_le", 'replace')
-            if mhod_type in mhod_type_map:
-                info[mhod_type_map[mhod_type]] = value
-            data = data[size:]
+        types = self.types
+        while (end - pos > 40) and (data[pos:pos+4] == "mhod"):
+            size, mhod_type = struct.unpack_from('<LL', data, pos + 8)
+            if size < 16:
+                raise InvalidFormat
+            if mhod_type in types:
+                info[types[mhod_type]] = unicode(data[pos+40:pos+size], "utf_16_le", 'replace')
+            pos += size
         return info
 
 
@@ -928,35 +1202,97 @@ def be3(x):
 
 SD_type_map = { "aac": 2, "mp4a": 2, "wave": 4}
 
-def MakeSDEntry(info):
+# an iTunesSD entry is a fixed 558-byte slot; the path is stored as UTF-16
+# and padded (or truncated) to 261 characters
+SD_ENTRY = struct.Struct("<6s20xB2xBxBx522sBBx")
+
+# number of entries that are packed into the buffer before it is written
+SD_BLOCK_ENTRIES = 256
+
+def PackSDEntry(buf, offset, info):
     path = info['path']
     if type(path) != types.UnicodeType:
         path = unicode(path, sys.getfilesystemencoding(), 'replace')
-    path = u'/' + path
-    return "\0\x02\x2E\x5A\xA5\x01" + (20*"\0") + \
-           "\x64\0\0%c\0\x02\0" % (SD_type_map.get(info.get('type', None), 1)) + \
-           path.encode("utf_16_le", 'replace') + \
-           ((261 - len(path)) * 2) * "\0" + \
-           "%c%c\0" % (info.get('shuffle flag', 1), info.get('bookmark flag', 0))
+    SD_ENTRY.pack_into(buf, offset,
+        "\0\x02\x2E\x5A\xA5\x01",
+        0x64,
+        SD_type_map.get(info.get('type', None), 1),
+        0x02,
+        (u'/' + path).encode("utf_16_le", 'replace'),
+        info.get('shuffle flag', 1),
+        info.get('bookmark flag', 0))
+
+def WriteiTunesSD(f, tracklist):
+    f.write(be3(len(tracklist)) + "\x01\x06\0\0\0\x12" + (9*"\0"))
+    size = SD_ENTRY.size
+    buf = array.array('c', SD_BLOCK_ENTRIES * size * "\0")
+    for start in xrange(0, len(tracklist), SD_BLOCK_ENTRIES):
+        offset = 0
+        for info in tracklist[start:start+SD_BLOCK_ENTRIES]:
+            PackSDEntry(buf, offset, info)
+            offset += size
+        f.write(buffer(buf, 0, offset))
 
 def iTunesSD(tracklist):
-    header = "\0\x02\x2E\x5A\xA5\x01" + (20*"\0") + "\x64\0\0\0x01\0\0x02\0"
-    return be3(len(tracklist)) + "\x01\x06\0\0\0\x12" + (9*"\0") + \
-           "".join(map(MakeSDEntry, tracklist))
+    f = cStringIO.StringIO()
+    WriteiTunesSD(f, tracklist)
+    return f.getvalue()
 
 
 ################################################################################
 ## some useful helper functions for "fine tuning" of track lists              ##
 ################################################################################
 
+# derive a 64-bit ID from a string; 'used' is a dictionary of the IDs
+# that are already taken, collisions are resolved by counting up
+def stable_id(text, used):
+    if type(text) == types.UnicodeType:
+        text = text.encode('utf_8', 'replace')
+    uid = struct.unpack("<Q", md5.new(str(text)).digest()[:8])[0]
+    while not(uid) or (uid in used):
+        uid = (uid + 1) & 0xFFFFFFFFFFFFFFFFL
+    used[uid] = None
+    return uid
+
+
+# Assign track IDs and dbids to the tracks that don't have valid ones yet.
+# Tracks keep the IDs from previous runs (they are stored in the cache), so
+# the database only changes where the library changed. New track IDs fill
+# the gaps from 1 upwards, new dbids are derived from the original path.
 def GenerateIDs(tracklist):
-    trackid = random.randint(0, (0xFFFF-0x1337) - len(tracklist))
-    dbid = random.randrange(0, 18446744073709551615L - len(tracklist))
+    ids = {}
+    dbids = {}
+    new = []
     for track in tracklist:
+        trackid = track.get('id', None)
+        dbid = track.get('dbid', None)
+        if (type(trackid) in (types.IntType, types.LongType)) and (0 < trackid < 0x100000000L) \
+        and (type(dbid) in (types.IntType, types.LongType)) and (0 < dbid < 0x10000000000000000L) \
+        and not(trackid in ids) and not(dbid in dbids):
+            ids[trackid] = None
+            dbids[dbid] = None
+        else:
+            new.append(track)
+    trackid = 1
+    for track in new:
+        while trackid in ids:
+            trackid += 1
+        ids[trackid] = None
         track['id'] = trackid
-        track['dbid'] = dbid
-        trackid += 1
-        dbid += 1
+        track['dbid'] = stable_id(track.get('original path', None) or track.get('path', ""), dbids)
+
+
+# read the database ID from an existing iTunesDB file
+def ReadDatabaseID(filename):
+    try:
+        f = open(filename, "rb")
+        header = f.read(32)
+        f.close()
+    except IOError:
+        return None
+    if (len(header) < 32) or (header[:4] != "mhbd"):
+        return None
+    return struct.unpack("<Q", header[24:32])[0]
 
 
 def GuessTitleAndArtist(filename):
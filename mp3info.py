@@ -17,7 +17,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import sys, re, zlib, struct, os, stat
+import sys, re, zlib, struct, os, stat, md5
 import qtparse
 
 
@@ -116,6 +116,11 @@ ID3v2FrameMap = {
 }
 
 RE_ID3v2_Frame_Type = re.compile(r'[A-Z0-9]{4}')
+
+# the fields rePear actually uses; other ID3v2 frames aren't even read
+STORED_FIELDS = ('title', 'artist', 'album', 'genre', 'composer', 'comment',
+                 'track number', 'total tracks', 'disc number', 'total discs',
+                 'year', 'BPM')
 RE_ID3v2_Strip_Genre = re.compile(r'\([0-9]+\)(.*)')
 
 
@@ -179,7 +184,27 @@ def GetCharset(encoding):
     else:               return "iso-8859-1"
 
 
-def GetEndID3v2(f, offset=0):
+# the set of frame IDs that are needed for a list of fields (None = all)
+wanted_frames_cache = {}
+def GetWantedFrames(fields):
+    if fields is None:
+        return None
+    try:
+        return wanted_frames_cache[fields]
+    except KeyError:
+        pass
+    wanted = {}
+    for frame, key in ID3v2FrameMap.iteritems():
+        for key in key.lstrip("#/").split("/"):
+            if key in fields:
+                wanted[frame] = None
+    wanted_frames_cache[fields] = wanted
+    return wanted
+
+
+# find an ID3v2 tag at the end of the file (before an optional ID3v1 tag,
+# whose negative offset is given); returns the file offset of the tag
+def FindEndID3v2(f, offset=0):
     try:
         f.seek(offset-10, 2)
         marker = f.read(10)
@@ -187,60 +212,76 @@ def GetEndID3v2(f, offset=0):
             return None
         size = DecodeSyncsafeInteger(marker[-4:]) + 10
         f.seek(offset-10-size, 2)
-        data = f.read(size)
-        if len(data)!=size or data[:3]!="ID3":
+        pos = f.tell()
+        if f.read(3)!="ID3":
             return None
-        return data
+        return pos
     except IOError:
         return None
 
 
-def GetStartID3v2(f):
+# Decode the ID3v2 tag at the given file offset. Only the headers of the
+# frames are read; the payload is only read for the frames that are needed
+# for the given fields, all other frames (like large embedded pictures)
+# are skipped. Returns the total size of the tag, or 0 if there is none.
+def ReadID3v2(f, offset, info, fields=None):
     try:
-        f.seek(0)
-        marker = f.read(10)
-        if len(marker)!=10 or marker[:3]!="ID3":
-            return None
-        size = DecodeSyncsafeInteger(marker[-4:])
-        payload = f.read(size)
-        if len(payload)!=size:
-            return None
-        return marker+payload
+        f.seek(offset)
+        header = f.read(10)
     except IOError:
-        return None
-
-
-def DecodeID3v2(data, info):
-    info['tag'] = "id3v2.%d.%d" % (ord(data[3]), ord(data[4]))
-    if ord(data[3]) >= 4:
+        return 0
+    if len(header)!=10 or header[:3]!="ID3":
+        return 0
+    end = offset + 10 + DecodeSyncsafeInteger(header[-4:])
+    try:
+        f.seek(end - 1)
+        if len(f.read(1))!=1:
+            return 0  # truncated tag
+        f.seek(offset + 10)
+    except IOError:
+        return 0
+    info['tag'] = "id3v2.%d.%d" % (ord(header[3]), ord(header[4]))
+    if ord(header[3]) >= 4:
         decode_size = DecodeSyncsafeInteger
     else:
         decode_size = DecodeInteger
+    wanted = GetWantedFrames(fields)
 
-    # parse header flags, strip header(s)
-    flags = ord(data[5])
-    data = data[10:]
-    if flags & 0x40:  # extended header
-        size = decode_size(data[:4])
-        data = data[size:]
-
-    # parse frames
-    while len(data)>=10:
-        frame = data[:4]
-        if not RE_ID3v2_Frame_Type.match(frame):
-            break  # invalid frame name or start of padding => bail out
-        size = decode_size(data[4:8])
-        payload = data[10:size+10]
-        flags = ord(data[9])
-        if flags & 0x02:
-            payload = payload.replace("\xff\0", "\xff")
-        if flags & 0x04:
-            try:
-                payload = zlib.decompress(payload)
-            except zlib.error:
-                continue  # this frame is broken
-        HandleID3v2Frame(frame, payload, flags, info)
-        data = data[size+10:]
+    try:
+        # skip extended header
+        pos = offset + 10
+        if ord(header[5]) & 0x40:
+            pos += decode_size(f.read(4))
+            f.seek(pos)
+
+        # parse frames
+        while pos + 10 <= end:
+            frame_header = f.read(10)
+            if len(frame_header)!=10:
+                break
+            frame = frame_header[:4]
+            if not RE_ID3v2_Frame_Type.match(frame):
+                break  # invalid frame name or start of padding => bail out
+            size = decode_size(frame_header[4:8])
+            pos += 10 + size
+            if (wanted is not None) and not(frame in wanted):
+                f.seek(pos)
+                continue
+            payload = f.read(max(0, min(pos, end) - (pos - size)))
+            if pos > end:
+                f.seek(pos)
+            flags = ord(frame_header[9])
+            if flags & 0x02:
+                payload = payload.replace("\xff\0", "\xff")
+            if flags & 0x04:
+                try:
+                    payload = zlib.decompress(payload)
+                except zlib.error:
+                    continue  # this frame is broken
+            HandleID3v2Frame(frame, payload, flags, info)
+    except IOError:
+        pass
+    return end - offset
 
 
 def HandleID3v2Frame(frame, payload, flags, info):
@@ -293,22 +334,65 @@ def HandleID3v2Frame(frame, payload, flags, info):
 
 
 ################################################################################
-## ultra-simple (and not very fault-tolerant) Ogg Vorbis metadata decoder     ##
+## simple Ogg Vorbis metadata decoder                                         ##
 ################################################################################
 
-def DecodeVorbisHeader(f, info):
-    try:
-        f.seek(0)
-        data = f.read(4096)   # almost one page, should be enough
-    except IOError:
-        return False
-    if data[:4]!="OggS": return False  # no Ogg -- don't bother
-    data = data.split("vorbis", 3)
-    if len(data)!=4: return False  # no Vorbis packets
-    info['format'] = "ogg"  # at this point, we can assume the stream is valid
-    info['filetype'] = "Ogg Vorbis"
-    data = data[2]
-    if len(data)<8: return True  # comment packet too short
+# The comment packet may span several pages and can contain huge fields
+# (e.g. embedded cover art); only this many bytes of it are collected.
+VORBIS_COMMENT_LIMIT = 262144
+
+# The last page of the stream is searched for in this many bytes at the end
+# of the file. Vorbis pages are typically only a few KiB large.
+OGG_TAIL_SIZE = 16384
+
+# comment fields that carry embedded cover art
+VORBIS_PICTURE_FIELDS = ("METADATA_BLOCK_PICTURE", "COVERART")
+
+def ReadOggPage(f):
+    header = f.read(27)
+    if (len(header) < 27) or (header[:4] != "OggS"):
+        return None
+    version, flags, granule, serial, seqno, crc, segments = \
+        struct.unpack("<BBqLLLB", header[4:])
+    lacing = f.read(segments)
+    if len(lacing) < segments:
+        return None
+    return (serial, [ord(c) for c in lacing])
+
+# reassembles the first <count> packets of the first logical stream in the
+# file; packets are truncated to <limit> bytes, the rest is skipped
+def ReadOggPackets(f, count, limit):
+    stream = None
+    packets = []
+    packet = []
+    size = 0
+    while len(packets) < count:
+        page = ReadOggPage(f)
+        if not page: break
+        serial, lacing = page
+        if stream is None:
+            stream = serial
+        if serial != stream:
+            f.seek(sum(lacing), 1)
+            continue
+        for segment in lacing:
+            wanted = max(0, min(segment, limit - size))
+            if wanted:
+                packet.append(f.read(wanted))
+            if segment > wanted:
+                f.seek(segment - wanted, 1)
+            size += segment
+            if segment < 255:
+                packets.append("".join(packet))
+                packet = []
+                size = 0
+                if len(packets) >= count: break
+    if packet and (len(packets) < count):
+        packets.append("".join(packet))  # incomplete, but still usable
+    return (stream, packets)
+
+def DecodeVorbisComment(data, info):
+    if len(data)<8: return  # comment packet too short
 
     # encoder version
     size = struct.unpack("<L", data[:4])[0]
@@ -316,7 +400,7 @@ def DecodeVorbisHeader(f, info):
     data = data[size+4:]
 
     # field count
-    if len(data)<8: return True  # comment packet too short
+    if len(data)<8: return  # comment packet too short
     count = struct.unpack("<L", data[:4])[0]
     data = data[4:]
 
@@ -329,7 +413,9 @@ def DecodeVorbisHeader(f, info):
             if "=" in line:
                 key, value = line.split('=', 1)
                 value = value.strip()
-                if key=="TRACKNUMBER":
+                if key.upper() in VORBIS_PICTURE_FIELDS:
+                    pass  # base64-encoded images, not text
+                elif key=="TRACKNUMBER":
                     try:
                         info["track number"] = int(value)
                     except ValueError:
@@ -338,6 +424,60 @@ def DecodeVorbisHeader(f, info):
                     info[key.lower()] = unicode(value, "utf_8", 'replace')
         data = data[size+4:]
 
+# The granule position of the last page of a Vorbis stream is the total
+# number of samples, so the exact length can be read from the end of the
+# file instead of decoding the whole stream.
+def GetOggGranule(f, stream):
+    f.seek(0, 2)
+    f.seek(max(0, f.tell() - OGG_TAIL_SIZE))
+    data = f.read(OGG_TAIL_SIZE)
+    pos = len(data)
+    while True:
+        pos = data.rfind("OggS", 0, pos)
+        if pos < 0:
+            return None
+        if len(data) - pos < 27:
+            continue
+        version, flags, granule, serial = struct.unpack("<BBqL", data[pos+4:pos+18])
+        if not(version) and (serial == stream) and (granule >= 0):
+            return granule
+
+def DecodeVorbisHeader(f, info):
+    try:
+        f.seek(0)
+        if f.read(4)!="OggS": return False  # no Ogg -- don't bother
+        f.seek(0)
+        stream, packets = ReadOggPackets(f, 2, VORBIS_COMMENT_LIMIT)
+    except IOError:
+        return False
+    if not(packets) or (packets[0][:7]!="\x01vorbis"):
+        return False  # no Vorbis stream
+    info['format'] = "ogg"  # at this point, we can assume the stream is valid
+    info['filetype'] = "Ogg Vorbis"
+
+    # identification header
+    ident = packets[0]
+    if len(ident) < 28: return True  # identification packet too short
+    version, channels, rate, max_rate, nominal_rate, min_rate = \
+        struct.unpack("<LBLlll", ident[7:28])
+    if rate:
+        info['sample rate'] = rate
+    if nominal_rate > 0:
+        info['bitrate'] = nominal_rate / 1000
+
+    # comment header
+    if (len(packets) > 1) and (packets[1][:7]=="\x03vorbis"):
+        DecodeVorbisComment(packets[1][7:], info)
+
+    # length
+    if rate:
+        try:
+            granule = GetOggGranule(f, stream)
+        except IOError:
+            granule = None
+        if granule:
+            info['length'] = float(granule) / rate
+
     return True
 
 
@@ -530,7 +670,7 @@ def DecodeMP4(f, info):
 ## toplevel GetAudioFileInfo() function                                       ##
 ################################################################################
 
-def GetAudioFileInfo(filename, stat_only=False):
+def GetAudioFileInfo(filename, stat_only=False, fields=STORED_FIELDS):
     try:
         s = os.stat(filename)
     except OSError:
@@ -567,20 +707,35 @@ def GetAudioFileInfo(filename, stat_only=False):
 
     # some ID3 probing
     end_offset = GetID3v1(f, info)
-    id3v2_data = GetEndID3v2(f, end_offset)
-    if id3v2_data:
-        DecodeID3v2(id3v2_data, info)
-    id3v2_data = GetStartID3v2(f)
-    if id3v2_data:
-        start_offset = len(id3v2_data)
-        DecodeID3v2(id3v2_data, info)
-    else:
-        start_offset = 0
+    id3v2_offset = FindEndID3v2(f, end_offset)
+    if id3v2_offset is not None:
+        ReadID3v2(f, id3v2_offset, info, fields)
+    start_offset = ReadID3v2(f, 0, info, fields)
     ScanMP3(f, info, start_offset)
 
     return info
 
 
+# A cheap content fingerprint that survives renaming and moving a file: the
+# file size plus a hash of the first and last 64 KiB.
+FINGERPRINT_BLOCK = 65536
+
+def GetFingerprint(filename, size=None):
+    f = file(filename, "rb")
+    try:
+        if size is None:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+        h = md5.new(f.read(FINGERPRINT_BLOCK))
+        if size > FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK, size - FINGERPRINT_BLOCK))
+            h.update(f.read(FINGERPRINT_BLOCK))
+    finally:
+        f.close()
+    return "%d:%s" % (size, h.hexdigest())
+
+
 ################################################################################
 ## a demo main function                                                       ##
 ################################################################################
@@ -592,7 +747,7 @@ if __name__=="__main__":
     for filename in sys.argv[1:]:
         print
         print "[%s]" % filename
-        info = GetAudioFileInfo(filename)
+        info = GetAudioFileInfo(filename, fields=None)
         if not info: continue
         keys = info.keys()
         keys.sort()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# path pattern matching library for rePear, the iPod database management tool
+# Copyright (C) 2008 Martin J. Fiedler <martin.fiedler@gmx.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os, re, fnmatch
+
+re_wildcard = re.compile(r'[*?[]')
+sep = os.path.normcase("/")
+
+
+################################################################################
+## a set of fnmatch-style patterns that is matched in one go                  ##
+################################################################################
+
+# Patterns are added with an arbitrary tag, and match() returns the tags of all
+# patterns that match a name, with the same semantics as fnmatch.fnmatch().
+# Most patterns are either plain file names or "some/directory/*" (that's what
+# the include and exclude options generate for directories), so these are
+# looked up in dictionaries: the former directly, the latter with every
+# directory prefix of the name. All remaining patterns are compiled into a
+# single regular expression per tag.
+
+class PatternSet:
+    def __init__(self, patterns=[], tag=None):
+        self.exact = {}
+        self.prefixes = {}
+        self.generic = {}
+        self.compiled = []
+        self.count = 0
+        for pattern in patterns:
+            self.add(pattern, tag)
+
+    def add(self, pattern, tag=None):
+        pattern = os.path.normcase(pattern)
+        if not re_wildcard.search(pattern):
+            self.exact.setdefault(pattern, []).append(tag)
+        elif pattern.endswith(sep + "*") and not re_wildcard.search(pattern[:-1]):
+            self.prefixes.setdefault(pattern[:-1], []).append(tag)
+        else:
+            self.generic.setdefault(tag, []).append(fnmatch.translate(pattern))
+            self.compiled = None
+        self.count += 1
+
+    def compile(self):
+        self.compiled = [(tag, re.compile("|".join(["(?:%s)" % r for r in regexps]))) \
+                         for tag, regexps in self.generic.iteritems()]
+
+    def __len__(self):
+        return self.count
+
+    def match(self, name):
+        name = os.path.normcase(name)
+        tags = self.exact.get(name, [])[:]
+        if self.prefixes:
+            pos = name.find(sep)
+            while pos >= 0:
+                tags.extend(self.prefixes.get(name[:pos+1], []))
+                pos = name.find(sep, pos + 1)
+        if self.compiled is None:
+            self.compile()
+        for tag, regexp in self.compiled:
+            if regexp.match(name):
+                tags.append(tag)
+        return tags
+
+
+################################################################################
+
+if __name__ == "__main__":
+    print "Do not start this file directly, start repear.py instead."
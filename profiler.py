@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# sampling profiler for rePear, the iPod database management tool
+# Copyright (C) 2008 Martin J. Fiedler <martin.fiedler@gmx.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys, os, time, thread, threading
+
+
+################################################################################
+## a low-overhead statistical profiler                                        ##
+################################################################################
+
+# A background thread looks at the stack of the profiled thread every
+# <interval> seconds. For every function, it counts the samples in which
+# the function was running ("self") and the samples in which it was
+# anywhere on the stack ("cumulative"). Unlike cProfile, this doesn't slow
+# down the profiled code itself, but the results are only estimates.
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = {}
+        self.cumulative_counts = {}
+        self.thread_id = None
+        self.running = False
+        self.sampler = None
+        self.wall = 0.0
+
+    def start(self):
+        self.thread_id = thread.get_ident()
+        self.running = True
+        self.wall = time.time()
+        self.sampler = threading.Thread(target=self.run)
+        self.sampler.setDaemon(True)
+        self.sampler.start()
+
+    def stop(self):
+        self.running = False
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+        self.wall = time.time() - self.wall
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame:
+                self.sample(frame)
+
+    def sample(self, frame):
+        self.samples += 1
+        key = self.frame_key(frame)
+        self.self_counts[key] = self.self_counts.get(key, 0) + 1
+        seen = {}
+        while frame:
+            key = self.frame_key(frame)
+            if not key in seen:
+                seen[key] = None
+                self.cumulative_counts[key] = self.cumulative_counts.get(key, 0) + 1
+            frame = frame.f_back
+
+    def frame_key(self, frame):
+        code = frame.f_code
+        return (code.co_filename, code.co_firstlineno, code.co_name)
+
+    def stats(self, sort='cumulative'):
+        keys = self.cumulative_counts.keys()
+        if sort == 'cumulative':
+            keys.sort(key=lambda k: (-self.cumulative_counts[k], -self.self_counts.get(k, 0), k))
+        else:
+            keys.sort(key=lambda k: (-self.self_counts.get(k, 0), -self.cumulative_counts[k], k))
+        return [(k, self.self_counts.get(k, 0), self.cumulative_counts[k]) for k in keys]
+
+    def print_stats(self, f=sys.stdout, limit=None, sort='cumulative'):
+        total = max(1, self.samples)
+        f.write("%d samples in %.3f seconds (%.1f ms interval)\n\n" % \
+                (self.samples, self.wall, self.interval * 1000.0))
+        f.write("   cumul%    self%  function\n")
+        stats = self.stats(sort)
+        if limit:
+            stats = stats[:limit]
+        for (filename, line, name), own, cumulative in stats:
+            f.write("%7.1f%% %7.1f%%  %s (%s:%d)\n" % \
+                    (100.0 * cumulative / total, 100.0 * own / total,
+                     name, os.path.basename(filename), line))
+
+    def dump_stats(self, filename):
+        f = open(filename, "w")
+        try:
+            self.print_stats(f)
+        finally:
+            f.close()
+
+
+################################################################################
+
+if __name__ == "__main__":
+    print "Do not start this file directly, start repear.py instead."
@@ -18,7 +18,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 __title__   = "rePear"
-__version__ = "0.4.1"
+__version__ = "0.4.2"
 __author__  = "Martin J. Fiedler"
 __email__   = "martin.fiedler@gmx.net"
 banner = "Welcome to %s, version %s" % (__title__, __version__)
@@ -26,6 +26,65 @@ banner = "Welcome to %s, version %s" % (__title__, __version__)
 """
 TODO: preserve .m3u playlists on update
 
+0.4.2:
+ - the iPod_Control/Music directory geometry now grows with the library size
+   (more than 100 directories and 100 files per directory for >8000 tracks)
+ - added 'rebalance' action to move files out of overfull music directories
+ - the track cache now stores the normalized path lookup keys of each entry,
+   one shared cache index is used for the whole freeze operation
+ - playlist sorting now computes one sort key per track instead of comparing
+   tracks pairwise
+ - all automatic playlists and the scrobble excludes are now matched with
+   precompiled pattern sets, in a single pass over the track list
+ - directory playlists are no longer merged if different directories have
+   the same name; such playlists are named after enough of their path to tell
+   them apart (e.g. "Album A/CD1" and "Album B/CD1")
+ - natural sort keys of file names are memoized, and the path sort key of each
+   track is stored in the track cache
+ - balanced shuffle now visits subdirectories in a well-defined order, so
+   results only depend on the random seed
+ - balanced shuffle runs in linear time per directory level
+ - added 'seed' playlist option for reproducible shuffling
+ - a timing report with the duration of each processing phase and the slowest
+   files is written next to the log file (repear.timing.json)
+ - added --profile and --profile-mode options to profile any action
+ - the console shows a compact progress line instead of one line per file,
+   unless the new --verbose option is given; the log file still contains all
+   details, but is written in larger blocks
+ - added --stage option to build all database files in a local directory and
+   copy them to the iPod in large sequential writes, replacing each file
+   atomically
+ - if only play counts, ratings and play times changed, 'update' patches them
+   into the existing iTunesDB and only rewrites the modified parts of the file
+ - track and playlist item records are packed with precompiled layouts, and
+   records no longer grow their data one child at a time, which made building
+   large databases take quadratic time
+ - the serialized artist, album, genre and file type strings are cached and
+   reused across tracks (hit and miss counts are in the timing report)
+ - added -j/--jobs option to serialize the track records in multiple worker
+   processes (requires Python 2.6 or later)
+ - the iTunesSD file is packed into a preallocated buffer and written in
+   blocks of 256 entries
+ - unfreeze plans all moves first, lists and creates each directory only once
+   and moves the files grouped by destination directory
+ - dissect reads the whole iTunesDB first and plans all moves in memory
+ - added -n/--dry-run option to show the moves of unfreeze and dissect without
+   moving anything
+ - the track cache stores a content fingerprint of each file, so that files
+   that have been moved or renamed while the iPod was unfrozen don't need to
+   be parsed again
+ - ID3v2 tags are read frame by frame; only the frames rePear stores are
+   decoded, embedded pictures and other large frames are skipped
+ - Ogg Vorbis files get their exact length from the last page of the file,
+   and comment headers that span several pages are read correctly
+ - track IDs are kept across freeze runs, playlist and database IDs no longer
+   change randomly, and tracks are always stored in the order of the original
+   directory tree, so freezing an unchanged library produces an identical
+   iTunesDB (except for playlists with the 'new' or 'changed' options, which
+   depend on what changed since the last run)
+ - frozen tracks keep the directory artwork they were given by the first
+   freeze when the iPod is frozen again
+
 0.4.1:
  - added artwork formats for nano 4G
  - added support for the 'mhii link' field, required for artwork on nano 4G
@@ -123,6 +182,8 @@ DEFAULT_LAME_OPTS = "--quiet -h -V 5"
 MASTER_PLAYLIST_FILE = "repear_playlists.ini"
 SCROBBLE_CONFIG_FILE = "repear_scrobble.ini"
 SUPPORTED_FILE_FORMATS = (".mp3", ".ogg", ".m4a", ".m4b", ".mp4")
+ACTIONS = ('auto', 'freeze', 'unfreeze', 'update', 'rebalance', 'dissect', 'reset',
+           'config', 'cfg-fwid', 'cfg-scrobble', 'cfg-model', 'help')
 MUSIC_DIR = "iPod_Control/Music/"
 CONTROL_DIR = "iPod_Control/iTunes/"
 ARTWORK_DIR = "iPod_Control/Artwork/"
@@ -135,11 +196,17 @@ ARTWORK_CACHE_FILE = ARTWORK_DIR + "repear.artwork_cache"
 ARTWORK_DB_FILE = ARTWORK_DIR + "ArtworkDB"
 def OLDNAME(x): return x.replace("repear", "retune")
 
-import sys, optparse, os, fnmatch, stat, string, time, types, cPickle, random
-import re, warnings, traceback, getpass, md5
+import sys, optparse, os, stat, string, time, types, cPickle, random
+import re, warnings, traceback, getpass, md5, math, tempfile, shutil
 warnings.filterwarnings('ignore', category=RuntimeWarning)  # for os.tempnam()
-import iTunesDB, mp3info, hash58, scrobble
+import iTunesDB, mp3info, hash58, scrobble, pathmatch, timing
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+import pstats
 Options = {}
+timer = timing.timer
 
 
 ################################################################################
@@ -148,6 +215,21 @@ Options = {}
 
 broken_log = False
 homedir = ""
+logfile = None
+
+# Log levels. Everything is written to the log file, but the console only
+# shows messages up to LOG_INFO, unless --verbose is given; per-file details
+# are replaced by a single progress line there. The log file is buffered and
+# flushed every LOG_FLUSH_INTERVAL seconds, except for errors and warnings,
+# which are flushed immediately.
+LOG_ERROR, LOG_WARNING, LOG_INFO, LOG_DETAIL = range(4)
+LOG_FLUSH_INTERVAL = 2.0
+PROGRESS_INTERVAL = 0.2
+console_level = LOG_INFO
+last_flush = 0.0
+pending_detail = ""
+progress_shown = False
+last_progress = 0.0
 
 def open_log():
     global logfile
@@ -157,20 +239,78 @@ def open_log():
     except IOError:
         logfile = None
 
-def log(line, flush=True):
-    global logfile
-    sys.stdout.write(line)
-    if flush: sys.stdout.flush()
+def log(line, flush=True, level=LOG_INFO):
+    global logfile, broken_log, last_flush, pending_detail
+    urgent = (level <= LOG_WARNING)
+
+    # console output
+    if level <= console_level:
+        clear_progress()
+        if urgent and pending_detail:
+            # show which file the error belongs to
+            sys.stdout.write(pending_detail)
+        pending_detail = ""
+        sys.stdout.write(line)
+        if flush or urgent: sys.stdout.flush()
+    elif '\n' in line:
+        pending_detail = line.rsplit('\n', 1)[1]
+    else:
+        pending_detail += line
+
+    # log file output
     if logfile:
         try:
             logfile.write(line)
-            if flush: logfile.flush()
+            now = time.time()
+            if urgent or ((now - last_flush) >= LOG_FLUSH_INTERVAL):
+                logfile.flush()
+                last_flush = now
         except IOError:
             broken_log = True
 iTunesDB.log = log
 
+def error(line):
+    log(line, True, LOG_ERROR)
+
+def warning(line):
+    log(line, True, LOG_WARNING)
+
+def detail(line):
+    log(line, False, LOG_DETAIL)
+
+def progress(line):
+    global progress_shown, last_progress
+    if (console_level >= LOG_DETAIL) or not(sys.stdout.isatty()):
+        return
+    now = time.time()
+    if (now - last_progress) < PROGRESS_INTERVAL:
+        return
+    last_progress = now
+    line = printable(line)
+    if len(line) > 78:
+        line = "..." + line[-75:]
+    sys.stdout.write("\r" + line.ljust(78))
+    sys.stdout.flush()
+    progress_shown = True
+
+def clear_progress():
+    global progress_shown
+    if progress_shown:
+        sys.stdout.write("\r" + 78 * " " + "\r")
+        progress_shown = False
+
+def write_timing_report():
+    if not timer.phases: return
+    filename = os.path.splitext(Options['log'])[0] + ".timing.json"
+    try:
+        timer.write(filename)
+    except IOError:
+        warning("WARNING: can't write timing report `%s'\n" % filename)
+
 def quit(code=1):
     global logfile, broken_log
+    write_timing_report()
+    clear_progress()
     if logfile:
         try:
             logfile.close()
@@ -179,7 +319,7 @@ def quit(code=1):
         logfile = None
     log("\nLog written to `%s'\n" % Options['log'])
     if broken_log:
-        log("WARNING: there were errors while writing the log file\n")
+        warning("WARNING: there were errors while writing the log file\n")
     if not Options.get('nowait', True):  # Windows: wait for keypress
         log("Press ENTER to close this window. ", True)
         try:
@@ -189,7 +329,7 @@ def quit(code=1):
     sys.exit(code)
 
 def fatal(line):
-    log("FATAL: %s\n" % line)
+    error("FATAL: %s\n" % line)
     quit()
 
 def confirm(prompt):
@@ -254,13 +394,15 @@ def load_cache(return_on_error=None):
     return content
 
 def save_cache(content=None):
+    timer.begin("save cache")
     try:
         f = open(CACHE_FILE, "wb")
         cPickle.dump(content, f)
         f.close()
         delete(OLDNAME(CACHE_FILE), True)
     except (IOError, EOFError, cPickle.PickleError):
-        log("ERROR: can't save the rePear cache\n")
+        error("ERROR: can't save the rePear cache\n")
+    timer.end()
 
 
 def execute(program, args):
@@ -275,7 +417,7 @@ def execute(program, args):
     try:
         return spawn(os.P_WAIT, path, [program] + args)
     except OSError, e:
-        log("ERROR: can't execute %s: %s\n" % (program, e.strerror))
+        error("ERROR: can't execute %s: %s\n" % (program, e.strerror))
     except KeyboardInterrupt:
         return -2
 
@@ -299,14 +441,14 @@ def printable(x, kill_chars=""):
 def move_file(src, dest):
     # check if source file exists
     if not os.path.isfile(src):
-        log("[FAILED]\nERROR: source file `%s' doesn't exist\n" %
-            printable(src), True)
+        error("[FAILED]\nERROR: source file `%s' doesn't exist\n" %
+            printable(src))
         return 'missing'
 
     # don't clobber files (wouldn't work on Windows anyway)
     if os.path.isfile(dest):
-        log("[FAILED]\nERROR: destination file `%s' already exists\n" %
-            printable(dest), True)
+        error("[FAILED]\nERROR: destination file `%s' already exists\n" %
+            printable(dest))
         return 'exists'
 
     # create parent directories if necessary
@@ -315,21 +457,170 @@ def move_file(src, dest):
         try:
             os.makedirs(dest_dir)
         except OSError, e:
-            log("[FAILED]\nERROR: can't create destination directory `%s': %s\n" %
-                (printable(dest_dir), e.strerror), True)
+            error("[FAILED]\nERROR: can't create destination directory `%s': %s\n" %
+                (printable(dest_dir), e.strerror))
             return 'mkdir'
 
     # finally rename it
     try:
         os.rename(src, dest)
     except OSError, e:
-        log(" [FAILED]\nERROR: can't move `%s' to `%s': %s\n" %
-            (printable(src), printable(dest), e.strerror), True)
+        error(" [FAILED]\nERROR: can't move `%s' to `%s': %s\n" %
+            (printable(src), printable(dest), e.strerror))
         return 'move'
-    log("[OK]\n", True)
+    detail("[OK]\n")
     return None
 
 
+# A batch of file moves that is planned completely before anything is moved.
+# Instead of checking the source, destination and parent directory of every
+# single file, each involved directory is listed once, and each missing
+# destination directory is created once. Collisions between the moves are
+# detected in memory. The moves are executed grouped by destination
+# directory, and every step is timed as "<name> plan", "<name> check" etc.
+class MovePlan:
+    def __init__(self, name="move", show_source=False):
+        self.name = name
+        self.show_source = show_source
+        self.moves = []     # list of [src, dest, dest_dir, error message, item]
+        self.dests = {}
+        self.listings = {}
+        self.failed_dirs = {}
+        timer.begin(name + " plan")
+
+    # the lowercase names in a directory, or None if it doesn't exist;
+    # lowercase, because the iPod's file system ignores case
+    def listing(self, dir):
+        try:
+            return self.listings[dir]
+        except KeyError:
+            pass
+        try:
+            names = dict([(name.lower(), None) for name in os.listdir(dir or ".")])
+        except OSError:
+            names = None
+        self.listings[dir] = names
+        return names
+
+    # check whether a file exists or is already the destination of a move
+    def taken(self, path):
+        if path.lower() in self.dests:
+            return True
+        dir, name = os.path.split(path)
+        names = self.listing(dir)
+        return bool(names) and (name.lower() in names)
+
+    # plan a move; 'item' is any object that identifies the move for the caller
+    def add(self, src, dest, item=None):
+        src = printable(src)
+        dest = printable(dest)
+        key = dest.lower()
+        if key in self.dests:
+            problem = "ERROR: destination file `%s' is also the destination of `%s'\n" % (dest, self.dests[key])
+        else:
+            self.dests[key] = src
+            problem = None
+        self.moves.append([src, dest, os.path.split(dest)[0], problem, item])
+
+    # check that all sources exist and no destination exists
+    def check(self):
+        timer.end(len(self.moves))
+        timer.begin(self.name + " check")
+        for move in self.moves:
+            src, dest, dest_dir, problem, item = move
+            if problem: continue
+            src_dir, src_name = os.path.split(src)
+            names = self.listing(src_dir)
+            if (names is None) or not(src_name.lower() in names):
+                move[3] = "ERROR: source file `%s' doesn't exist\n" % src
+                continue
+            names = self.listing(dest_dir)
+            if names and (os.path.split(dest)[1].lower() in names):
+                move[3] = "ERROR: destination file `%s' already exists\n" % dest
+        timer.end(len(self.moves))
+
+    # create all missing destination directories
+    def make_dirs(self):
+        timer.begin(self.name + " mkdir")
+        dirs = {}
+        for src, dest, dest_dir, problem, item in self.moves:
+            if dest_dir and not(problem):
+                dirs[dest_dir] = None
+        dirs = dirs.keys()
+        dirs.sort()  # parents first
+        created = 0
+        for dir in dirs:
+            if self.listing(dir) is not None:
+                continue
+            parent = os.path.split(dir)[0]
+            if parent in self.failed_dirs:
+                self.failed_dirs[dir] = self.failed_dirs[parent]
+                continue
+            try:
+                os.makedirs(dir)
+                created += 1
+            except OSError, e:
+                if not os.path.isdir(dir):
+                    self.failed_dirs[dir] = e.strerror
+                    continue
+            self.listings[dir] = {}
+        timer.end(created)
+
+    # execute all moves; returns the number of successful and failed moves
+    def execute(self):
+        self.check()
+        self.make_dirs()
+        timer.begin(self.name + " rename")
+        moves = self.moves[:]
+        moves.sort(key=lambda move: move[2])
+        success = 0
+        failed = 0
+        for move in moves:
+            src, dest, dest_dir, problem, item = move
+            progress("[%d/%d] %s" % (success + failed + 1, len(moves), dest))
+            if self.show_source:
+                detail("%s => %s " % (src, dest))
+            else:
+                detail("%s " % dest)
+            if not(problem) and (dest_dir in self.failed_dirs):
+                problem = "ERROR: can't create destination directory `%s': %s\n" % \
+                        (dest_dir, self.failed_dirs[dest_dir])
+            if not problem:
+                try:
+                    os.rename(src, dest)
+                except OSError, e:
+                    problem = "ERROR: can't move `%s' to `%s': %s\n" % (src, dest, e.strerror)
+            if problem:
+                error("[FAILED]\n" + problem)
+                move[3] = problem
+                failed += 1
+            else:
+                detail("[OK]\n")
+                success += 1
+        timer.end(len(moves))
+        return (success, failed)
+
+    # the items of all moves that succeeded, in the order they were planned
+    def succeeded(self):
+        return [move[4] for move in self.moves if not move[3]]
+
+    # only log the planned moves and the problems that were found
+    def dry_run(self):
+        self.check()
+        dirs = {}
+        failed = 0
+        for src, dest, dest_dir, problem, item in self.moves:
+            if problem:
+                error("%s => %s [FAILED]\n%s" % (src, dest, problem))
+                failed += 1
+            else:
+                log("%s => %s\n" % (src, dest), False, LOG_INFO)
+                if dest_dir and (self.listing(dest_dir) is None):
+                    dirs[dest_dir] = None
+        log("Dry run: %d files would be moved, %d would fail, %d directories would be created.\n" % \
+            (len(self.moves) - failed, failed, len(dirs)))
+
+
 def backup(filename):
     dest = "%s.repear_backup" % filename
     if os.path.exists(dest): return
@@ -337,7 +628,7 @@ def backup(filename):
         os.rename(filename, dest)
         return True
     except OSError, e:
-        log("WARNING: Cannot backup `%s': %s\n" % (filename, e.strerror))
+        warning("WARNING: Cannot backup `%s': %s\n" % (filename, e.strerror))
         return False
 
 
@@ -348,14 +639,129 @@ def delete(filename, may_fail=False):
         return True
     except OSError, e:
         if not may_fail:
-            log("ERROR: Cannot delete `%s': %s\n" % (filename, e.strerror))
+            error("ERROR: Cannot delete `%s': %s\n" % (filename, e.strerror))
         return False
 
+# the shuffle's playback state refers to the old iTunesSD
+def reset_shuffle_state():
+    delete(CONTROL_DIR + "iTunesShuffle")
+    delete(CONTROL_DIR + "iTunesPState")
+
+
+# In staging mode, the database files are built in a local temporary directory
+# and copied to the iPod at the very end, in large sequential blocks. Every
+# file is written under a temporary name first, flushed to the device and
+# then renamed into place, so an interrupted sync never leaves a partially
+# written file behind.
+STAGE_BLOCK_SIZE = 1024 * 1024
+
+class Stage:
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="repear-stage-")
+        self.files = []  # list of (staged file, destination, make backup)
+
+    def path(self, dest, make_backup=True):
+        # return the staging file name for <dest> and schedule its installation
+        src = os.path.join(self.dir, "%d_%s" % (len(self.files), os.path.basename(dest)))
+        self.files.append((src, dest, make_backup))
+        return src
+
+    def subdir(self, name):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return path
+
+    def adopt(self, src_dir, dest_dir, make_backup=False):
+        # schedule the installation of all files in a staging subdirectory
+        names = os.listdir(src_dir)
+        names.sort()
+        for name in names:
+            self.files.append((os.path.join(src_dir, name), dest_dir + name, make_backup))
+
+    def install(self):
+        ok = True
+        for src, dest, make_backup in self.files:
+            try:
+                install_file(src, dest, make_backup)
+            except (IOError, OSError), e:
+                error("FAILED\nERROR: can't copy `%s' to the iPod: %s\n" % (dest, e.strerror or e))
+                delete(dest + ".repear_new", True)
+                ok = False
+        return ok
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, True)
+
+def install_file(src, dest, make_backup=True):
+    temp = dest + ".repear_new"
+    fin = open(src, "rb")
+    try:
+        fout = open(temp, "wb")
+        try:
+            while True:
+                block = fin.read(STAGE_BLOCK_SIZE)
+                if not block: break
+                fout.write(block)
+            fout.flush()
+            os.fsync(fout.fileno())
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+    if make_backup:
+        backup(dest)
+    if (os.name == 'nt') and os.path.exists(dest):
+        os.remove(dest)  # Windows can't rename over existing files
+    os.rename(temp, dest)
+    # keep the modification time, the artwork cache depends on it
+    s = os.stat(src)
+    os.utime(dest, (s[stat.ST_ATIME], s[stat.ST_MTIME]))
+
 
 class ExceptionLogHelper:
+    def __init__(self, level=LOG_ERROR):
+        self.level = level
     def write(self, s):
-        log(s)
+        log(s, level=self.level)
 Logger = ExceptionLogHelper()
+InfoLogger = ExceptionLogHelper(LOG_INFO)
+
+
+# a function wrapper that remembers the results of the most recent calls
+class LRUCache:
+    def __init__(self, func, size=10000):
+        self.func = func
+        self.size = size
+        self.links = {}
+        # circular doubly linked list of [prev, next, arg, result] entries,
+        # from the least to the most recently used one
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __call__(self, arg):
+        root = self.root
+        link = self.links.get(arg, None)
+        if link is not None:
+            # hit: move the entry to the end of the list
+            prev, next, arg, result = link
+            prev[1] = next
+            next[0] = prev
+        else:
+            result = self.func(arg)
+            if len(self.links) >= self.size:
+                # drop the least recently used entry
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.links[oldest[2]]
+            link = [None, None, arg, result]
+            self.links[arg] = link
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+        return result
 
 
 # path and file name sorting routines
@@ -365,38 +771,36 @@ def tryint(s):
     except ValueError: return s.lower()
 def fnrep(fn):
     return tuple(map(tryint, re_digit.split(fn)))
-def fncmp(a, b):
-    return cmp(fnrep(a), fnrep(b))
-def pathcmp(a, b):
-    a = a.split(u'/')
-    b = b.split(u'/')
-    # compare base directories
-    for i in xrange(min(len(a), len(b)) - 1):
-        r = fncmp(a[i], b[i])
-        if r: return r
-    # subdirectories first
-    r = len(b) - len(a)
-    if r: return r
-    # finally, compare leaf file name
-    return fncmp(a[-1], b[-1])
-def trackcmp(a, b):
-    return pathcmp(a.get('original path', None) or a.get('path', '???'), \
-                   b.get('original path', None) or b.get('path', '???'))
+# memoized fnrep(); all path and file name ordering should use this one
+natural_key = LRUCache(fnrep, 50000)
+# path sort key: directories are compared component by component in natural
+# order; a base directory component is tagged with 0, the leaf file name with
+# 1, so subdirectories sort before the files next to them
+def path_sort_key(path):
+    path = path.split(u'/')
+    return tuple([(0, natural_key(x)) for x in path[:-1]] + [(1, natural_key(path[-1]))])
 
 
 ################################################################################
 ## Filename Allocator                                                         ##
 ################################################################################
 
+# Directory geometry of the music directory: up to 8,000 files, the classic
+# 100 directories with 100 files each are used (leaving 25% headroom for new
+# files). Beyond that, both dimensions grow with the square root of the
+# library size plus that headroom, so that no single directory gets
+# excessively large -- name lookup in a FAT directory is linear, both for the
+# iPod firmware and for us.
+def music_geometry(count):
+    size = int(math.ceil(math.sqrt(count * 1.25)))
+    return (max(100, size), max(100, size))
+
 class Allocator:
-    def __init__(self, root, files_per_dir=100, max_dirs=100):
+    def __init__(self, root, files_per_dir=None, max_dirs=None, expected=0):
         self.root = root
-        self.files_per_dir = files_per_dir
-        self.max_dirs = max_dirs
         self.names = {}
         self.files = {}
         digits = []
-        digits = []
         try:
             dirs = os.listdir(root)
         except OSError:
@@ -419,6 +823,14 @@ class Allocator:
             self.mkdir(0)
         self.current_dir = min(self.files.iterkeys())
 
+        # choose the directory geometry, unless it has been set explicitly
+        self.fixed_geometry = bool(files_per_dir and max_dirs)
+        if self.fixed_geometry:
+            self.files_per_dir = files_per_dir
+            self.max_dirs = max_dirs
+        else:
+            self.files_per_dir, self.max_dirs = music_geometry(max(len(self), expected))
+
     def getindex(self, name):
         if not name: raise ValueError
         if name[0].upper() != 'F': raise ValueError
@@ -459,6 +871,10 @@ class Allocator:
 
     def allocate(self):
         count, index = min([(len(d[1]), d[0]) for d in self.files.iteritems()])
+        # all directories are full: grow the geometry along with the library
+        if (count >= self.files_per_dir) and (len(self.files) >= self.max_dirs) \
+        and not(self.fixed_geometry):
+            self.files_per_dir, self.max_dirs = music_geometry(len(self) + 1)
         # need to allocate a new directory
         if (count >= self.files_per_dir) and (len(self.files) < self.max_dirs):
             available = [i for i in range(self.max_dirs) if not i in self.files]
@@ -472,56 +888,91 @@ class Allocator:
         self.files[index][name] = None
         return self.root + '/' + self.names[index] + '/' + name
 
+    def split(self, fullname):
+        dirname, filename = fullname.split('/')[-2:]
+        return (self.getindex(dirname), dirname, os.path.splitext(filename)[0].upper())
+
     def add(self, fullname):
         try:
-            dirname, filename = fullname.split('/')[-2:]
-            index = self.getindex(dirname)
+            index, dirname, filename = self.split(fullname)
         except ValueError:
             return
-        filename = os.path.splitext(filename)[0]
         if not index in self.files:
             self.names[index] = dirname
             self.files[index] = {}
         self.files[index][filename] = None
 
+    def remove(self, fullname):
+        try:
+            index, dirname, filename = self.split(fullname)
+            del self.files[index][filename]
+        except (ValueError, KeyError):
+            pass
+
+    def contains(self, fullname):
+        try:
+            index, dirname, filename = self.split(fullname)
+        except ValueError:
+            return False
+        return filename in self.files.get(index, {})
+
+    def overfull(self):
+        return [index for index, names in self.files.iteritems() \
+                if len(names) > self.files_per_dir]
+
+    def excess(self, fullname):
+        try:
+            index = self.split(fullname)[0]
+        except ValueError:
+            return 0
+        return max(0, len(self.files.get(index, {})) - self.files_per_dir)
+
 
 ################################################################################
 ## Balanced Shuffle                                                           ##
 ################################################################################
 
+# The shuffle works bottom-up: the items of every directory are shuffled, then
+# the (already shuffled) subdirectories are interleaved "column by column":
+# each subdirectory is spread evenly over as many columns as the largest one
+# has items, and every column is emitted in random directory order. Every
+# tree level is processed in linear time. If a seed is given, a private
+# random generator is used, so equal input produces equal output.
 class BalancedShuffle:
-    def __init__(self):
+    def __init__(self, seed=None):
         self.root = { None: [] }
+        if seed is None:
+            self.random = random
+        else:
+            self.random = random.Random(seed)
 
     def add(self, path, data):
         if type(path) == types.UnicodeType:
             path = path.encode('ascii', 'replace')
-        path = path.replace("\\", "/").lower().split("/")
-        if path and not(path[0]):
-            path.pop(0)
+        path = filter(None, path.replace("\\", "/").lower().split("/"))
         if not path:
             return  # broken path
         root = self.root
-        while True:
-            if len(path) == 1:
-                # tail reached
-                root[None].append(data)
-                break
-            component = path.pop(0)
-            if not component in root:
-                root[component] = { None: [] }
-            root = root[component]
+        for component in path[:-1]:
+            try:
+                root = root[component]
+            except KeyError:
+                root[component] = node = { None: [] }
+                root = node
+        root[None].append(data)
 
     def shuffle(self, root=None):
         if not root:
             root = self.root
+        rnd = self.random
 
         # shuffle the files of the root node
-        random.shuffle(root[None])
+        rnd.shuffle(root[None])
 
         # build a list of directories to shuffle
-        subdirs = filter(None, [root[None]] + \
-                  [self.shuffle(root[key]) for key in root if key])
+        keys = [key for key in root if key]
+        keys.sort(key=natural_key)
+        subdirs = filter(None, [root[None]] + [self.shuffle(root[key]) for key in keys])
 
         # check for "tail" cases
         if not subdirs:
@@ -529,58 +980,57 @@ class BalancedShuffle:
         if len(subdirs) == 1:
             return subdirs[0]
 
-        # pad subdirectory list to a common length
-        dircount = len(subdirs)
+        # distribute the items of all directories into the columns
         maxlen = max(map(len, subdirs))
-        subdirs = [self.fill(sd, maxlen) for sd in subdirs]
-
-        # collect all items
+        columns = [[] for i in xrange(maxlen)]
+        for d in xrange(len(subdirs)):
+            data = subdirs[d]
+            for pos, item in zip(self.spread(len(data), maxlen), data):
+                columns[pos].append((d, item))
+
+        # collect all items; a column never starts with the directory that
+        # ended the previous one
         res = []
         last = -1
-        for i in xrange(maxlen):
-            # determine the directory order for this "column"
-            order = range(dircount)
-            random.shuffle(order)
-            if (len(order) > 1) and (order[0] == last):
-                order.append(order.pop(0))
-            while len(order) > 1:  # = if len(order) > 1: while True:
-                random.shuffle(order)
-                if last != order[0]: break
-            last = order[-1]
-
-            # produce a result
-            res.extend(filter(lambda x: x is not None, \
-                       [subdirs[j][i] for j in order]))
+        for column in columns:
+            rnd.shuffle(column)
+            if (len(column) > 1) and (column[0][0] == last):
+                other = rnd.randrange(1, len(column))
+                column[0], column[other] = column[other], column[0]
+            last = column[-1][0]
+            res.extend([item for d, item in column])
         return res
 
-    def fill(self, data, total):
-        ones = len(data)
-        invert = (ones > (total / 2))
-        if invert:
-            ones = total - ones
-        bitmap = [0] * total
-        remain = total
-        for fraction in xrange(ones, 0, -1):
-            bitmap[total - remain] = 1
-            skip = float(remain) / fraction
-            skip = random.randrange(int(0.9 * skip), int(1.1 * skip) + 2)
-            remain -= min(max(1, skip), remain - fraction + 1)
-        if invert:
-            bitmap = [1-x for x in bitmap]
-        offset = random.randrange(0, total)
-        bitmap = bitmap[offset:] + bitmap[:offset]
-        def decide(x):
-            if x: return data.pop(0)
-            return None
-        return map(decide, bitmap)
+    def spread(self, count, total):
+        # choose <count> distinct, evenly spaced positions out of <total>:
+        # one position near the center of each of <count> equally sized
+        # strata, with some jitter, rotated by a random offset
+        rnd = self.random
+        offset = rnd.randrange(0, total)
+        res = []
+        lower = 0
+        for i in xrange(1, count + 1):
+            upper = (i * total) // count
+            width = upper - lower
+            pos = lower + min(width - 1, int(width * rnd.uniform(0.4, 0.6)))
+            res.append((pos + offset) % total)
+            lower = upper
+        return res
 
 
 ################################################################################
 ## Play Counts import and Scrobbling                                          ##
 ################################################################################
 
-def ImportPlayCounts(cache, index, scrobbler=None):
+def ImportPlayCounts(index, scrobbler=None):
     log("Updating play counts and ratings ... ", True)
+    timer.begin("play counts import")
+    try:
+        return import_play_counts(index, scrobbler)
+    finally:
+        timer.end()
+
+def import_play_counts(index, scrobbler):
 
     # open Play Counts file
     try:
@@ -589,22 +1039,22 @@ def ImportPlayCounts(cache, index, scrobbler=None):
         log("\n0 track(s) updated.\n")
         return False
     except iTunesDB.InvalidFormat:
-        log("\n-- Error in Play Counts file, import failed.\n")
+        error("\n-- Error in Play Counts file, import failed.\n")
         return False
 
     # parse old iTunesDB
     try:
         db = iTunesDB.DatabaseReader()
-        files = [printable(item.get('path', u'??')[1:].replace(u':', u'/')).lower() for item in db]
+        files = [path_key(item.get('path', u'??')[1:].replace(u':', u'/')) for item in db]
         db.f.close()
         del db
     except (IOError, iTunesDB.InvalidFormat):
-        log("\n-- Error in iTunesDB, import failed.\n")
+        error("\n-- Error in iTunesDB, import failed.\n")
         return False
 
     # plausability check
     if len(files) != pc.entry_count:
-        log("\n-- Mismatch between iTunesDB and Play Counts file, import failed.\n")
+        error("\n-- Mismatch between iTunesDB and Play Counts file, import failed.\n")
         return False
 
     # walk through Play Counts file
@@ -613,7 +1063,7 @@ def ImportPlayCounts(cache, index, scrobbler=None):
         for item in pc:
             path = files[item.index]
             try:
-                track = cache[index[path]]
+                track = index[path]
             except (KeyError, IndexError):
                 continue
             updated = False
@@ -637,12 +1087,13 @@ def ImportPlayCounts(cache, index, scrobbler=None):
                 updated = True
             if updated:
                 update_count += 1
+                timer.count("play counts updated")
             if item.play_count and scrobbler:
                 scrobbler += track
         pc.f.close()
         del pc
     except (IOError, iTunesDB.InvalidFormat):
-        log("\n-- Error in Play Counts file, import failed.\n")
+        error("\n-- Error in Play Counts file, import failed.\n")
         return False
     log("%d track(s) updated.\n" % update_count)
     return update_count
@@ -666,52 +1117,73 @@ WARNING: The database is currently unfrozen, so the following operations will
 almost completely fail.
 """)
 
-    cache = []
+    # read the whole database first
+    log("Reading iTunesDB ...\n", True)
+    timer.begin("dissect read")
     try:
-        db = iTunesDB.DatabaseReader()
-
-        for info in db:
-            if not info.get('path', None):
-                log("ERROR: track lacks path attribute\n")
-                continue
-            src = printable(info['path'])[1:].replace(":", "/")
-            if not os.path.isfile(src):
-                log("ERROR: file `%s' is found in database, but doesn't exist\n" % src)
-                continue
-            if not info.get('title', None):
-                info.update(iTunesDB.GuessTitleAndArtist(info['path']))
-            ext = os.path.splitext(src)[1]
-            base = DISSECT_BASE_DIR
-            if info.get('artist', None):
-                base += printable(info['artist'], "<>/\\:|?*\"") + '/'
-                if info.get('album', None):
-                    base += printable(info['album'], "<>/\\:|?*\"") + '/'
-                    if info.get('track number', None):
-                        base += "%02d - " % info['track number']
-            base += printable(info['title'], "<>/\\:|?*\"")
-
-            # move the file, but avoid filename collisions
-            serial = 1
-            dest = base + ext
-            while os.path.exists(dest):
-                serial += 1
-                dest = base + " (%d)"%serial + ext
-            log("%s => %s " % (src, dest), True)
-            if move_file(src, dest):
-                continue   # move failed
-
-            # create a placeholder cache entry
-            cache.append({
-                'path': src,
-                'original path': unicode(dest, sys.getfilesystemencoding(), 'replace')
-            })
+        db = iTunesDB.DatabaseReader(fields=('path', 'title', 'artist', 'album'))
+        tracks = list(db)
+        db.f.close()
+        del db
     except IOError:
         fatal("can't read iTunes database file")
     except iTunesDB.InvalidFormat:
         raise
         fatal("invalid iTunes database format")
+    timer.end(len(tracks))
+
+    # plan all moves; filename collisions are resolved in memory
+    log("Planning the new directory structure ...\n", True)
+    plan = MovePlan("dissect", show_source=True)
+    for info in tracks:
+        if not info.get('path', None):
+            error("ERROR: track lacks path attribute\n")
+            continue
+        src = printable(info['path'])[1:].replace(":", "/")
+        src_dir, src_name = os.path.split(src)
+        names = plan.listing(src_dir)
+        if (names is None) or not(src_name.lower() in names):
+            error("ERROR: file `%s' is found in database, but doesn't exist\n" % src)
+            continue
+        if not info.get('title', None):
+            info.update(iTunesDB.GuessTitleAndArtist(info['path']))
+        ext = os.path.splitext(src)[1]
+        base = DISSECT_BASE_DIR
+        if info.get('artist', None):
+            base += printable(info['artist'], "<>/\\:|?*\"") + '/'
+            if info.get('album', None):
+                base += printable(info['album'], "<>/\\:|?*\"") + '/'
+                if info.get('track number', None):
+                    base += "%02d - " % info['track number']
+        base += printable(info['title'], "<>/\\:|?*\"")
+
+        # avoid filename collisions
+        serial = 1
+        dest = base + ext
+        while plan.taken(dest):
+            serial += 1
+            dest = base + " (%d)"%serial + ext
+        plan.add(src, dest, (src, dest))
+
+    if Options['dry_run']:
+        plan.dry_run()
+        return
 
-    # clear the cache
+    # move the files
+    log("Moving files ...\n", True)
+    success, failed = plan.execute()
+    log("Operation complete: %d tracks total, %d moved, %d failed.\n" % \
+        (len(tracks), success, failed))
+
+    # create placeholder cache entries
+    cache = []
+    for src, dest in plan.succeeded():
+        info = {
+            'path': src,
+            'original path': unicode(dest, sys.getfilesystemencoding(), 'replace')
+        }
+        set_cache_keys(info)
+        cache.append(info)
     save_cache(("unfrozen", cache))
 
 
@@ -721,6 +1193,7 @@ almost completely fail.
 ################################################################################
 
 g_freeze_error_count = 0
+g_freeze_file_count = 0
 
 def check_file(base, fn):
     if fn.startswith('.'):
@@ -730,33 +1203,108 @@ def check_file(base, fn):
     try:
         s = os.stat(fullname)
     except OSError:
-        log("ERROR: directory entry `%s' is inaccessible\n" % fn)
+        error("ERROR: directory entry `%s' is inaccessible\n" % fn)
         return None
     isfile = int(not(stat.S_ISDIR(s[stat.ST_MODE])))
     if isfile and not(stat.S_ISREG(s[stat.ST_MODE])):
         return None   # no directory and no normal file -> skip this crap
     if not(isfile) and (fullname=="iPod_Control" or fullname=="iPod_Control/Music"):
         isfile = -1   # trick the sort algorithm to move iPC/Music to front
-    return (isfile, fnrep(fn), fullname, s, ext, key)
+    return (isfile, natural_key(fn), fullname, s, ext, key)
 
 
-def make_cache_index(cache):
-    index = {}
-    for i in xrange(len(cache)):
-        for path in [cache[i][f] for f in ('path', 'original path') if f in cache[i]]:
-            key = printable(path).lower()
-            if key in index:
-                log("ERROR: `%s' is cached multiple times\n" % printable(path))
-            else:
-                index[key] = i
-    return index
+def path_key(path):
+    return printable(path).lower()
+
 
+# Every cache entry carries the normalized lookup keys of its paths and its
+# path sort key, so they only need to be computed when a path changes, not on
+# every index build or sort operation. This function must be called whenever
+# 'path' or 'original path' changes.
+def set_cache_keys(info):
+    keys = tuple([path_key(info[f]) for f in ('path', 'original path') if f in info])
+    info['index keys'] = keys
+    info['path sort key'] = path_sort_key(info.get('original path', None) or info.get('path', '???'))
+    return keys
 
-def find_in_cache(cache, index, path, s):
-    i = index.get(printable(path).lower(), None)
-    if i is None:
+def track_sort_key(track):
+    try:
+        return track['path sort key']
+    except KeyError:
+        return path_sort_key(track.get('original path', None) or track.get('path', '???'))
+
+
+class CacheIndex:
+    def __init__(self, tracklist=[]):
+        self.build(tracklist)
+
+    def build(self, tracklist):
+        index = {}
+        for info in tracklist:
+            keys = info.get('index keys', None)
+            if keys is None:
+                keys = set_cache_keys(info)  # old (<0.4.2) cache file
+            for key in keys:
+                if key in index:
+                    error("ERROR: `%s' is cached multiple times\n" % key)
+                else:
+                    index[key] = info
+        self.index = index
+        self.tracklist = tracklist
+        self.albums = None  # built on demand
+        self.fingerprints = None  # built on demand
+        self.claimed = {}
+
+    # number of tracks per album, used to detect album playlists
+    def album_count(self, album):
+        if self.albums is None:
+            self.albums = {}
+            for info in self.tracklist:
+                if not 'album' in info: continue
+                try:
+                    self.albums[info['album']] = self.albums.get(info['album'], 0) + 1
+                except (TypeError, UnicodeDecodeError):
+                    # old (<0.3.0) cache files contain non-unicode information
+                    # for ID3v1 tags which can cause trouble here, so ...
+                    continue
+        try:
+            return self.albums.get(album, 0)
+        except (TypeError, UnicodeDecodeError):
+            return 0
+
+    # Find the cache entry of a file that has been moved or renamed. Each
+    # entry is only handed out once, and only if its file isn't at any of
+    # its old locations any more (otherwise, it's a copy).
+    def find_moved(self, fingerprint):
+        if self.fingerprints is None:
+            self.fingerprints = {}
+            for info in self.tracklist:
+                fp = info.get('fingerprint', None)
+                if fp and not(fp in self.fingerprints):
+                    self.fingerprints[fp] = info
+        info = self.fingerprints.get(fingerprint, None)
+        if (info is None) or (id(info) in self.claimed):
+            return None
+        for field in ('path', 'original path'):
+            if (field in info) and os.path.exists(printable(info[field])):
+                return None
+        self.claimed[id(info)] = None
+        return info
+
+    def get(self, key, default=None):
+        return self.index.get(key, default)
+
+    def __getitem__(self, key):
+        return self.index[key]
+
+    def __len__(self):
+        return len(self.index)
+
+
+def find_in_cache(index, path, s):
+    info = index.get(path_key(path), None)
+    if info is None:
         return (False, None)  # not found
-    info = cache[i]
 
     # check size and modification time
     if info.get('size', None) != s[stat.ST_SIZE]:
@@ -786,11 +1334,11 @@ def move_music(src, dest, info):
         res = execute("oggdec", ["-Q", "-o", tmp, src])
         if res != 0:
             g_freeze_error_count += 1
-            log("[FAILED]\nERROR: cannot execute OggDec ... result '%s'\n" % res)
+            error("[FAILED]\nERROR: cannot execute OggDec ... result '%s'\n" % res)
             delete(tmp, may_fail=True)
             return None
         else:
-            log("[decoded] ", True)
+            detail("[decoded] ")
 
         # build LAME option list
         lameopts = Options['lameopts'].split(' ')
@@ -809,22 +1357,22 @@ def move_music(src, dest, info):
         delete(tmp)
         if res != 0:
             g_freeze_error_count += 1
-            log("[FAILED]\nERROR: cannot execute LAME ... result code %d\n" % res)
+            error("[FAILED]\nERROR: cannot execute LAME ... result code %d\n" % res)
             return None
         else:
-            log("[encoded] ", True)
+            detail("[encoded] ")
 
         # check the resulting file
         info = mp3info.GetAudioFileInfo(dest)
         if not info:
             g_freeze_error_count += 1
-            log("[FAILED]\nERROR: generated MP3 file is invalid\n")
+            error("[FAILED]\nERROR: generated MP3 file is invalid\n")
             delete(dest)
             return None
         delete(src)
         info['original path'] = newsrc
         info['changed'] = 2
-        log("[OK]\n", True)
+        detail("[OK]\n")
         return info
 
     else:  # no Ogg file  ->  move directly
@@ -835,17 +1383,17 @@ def move_music(src, dest, info):
             return info
 
 
-def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
-    global g_freeze_error_count
+def freeze_dir(index, allocator, playlists=[], base="", artwork=None):
+    global g_freeze_error_count, g_freeze_file_count
     try:
         flist = filter(None, [check_file(base, fn) for fn in os.listdir(base or ".")])
     except KeyboardInterrupt:
         raise
     except:
         g_freeze_error_count += 1
-        log(base + "/\n" + " runtime error, traceback follows ".center(79, '-') + "\n")
+        error(base + "/\n" + " runtime error, traceback follows ".center(79, '-') + "\n")
         traceback.print_exc(file=Logger)
-        log(79*'-' + "\n")
+        error(79*'-' + "\n")
         return []
 
     # generate directory list
@@ -888,7 +1436,7 @@ def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
     # recurse into subdirectories first
     res = []
     for isfile, dummy, fullname, s, ext, key in directories:
-        res.extend(freeze_dir(cache, index, allocator, playlists, fullname + '/', artwork))
+        res.extend(freeze_dir(index, allocator, playlists, fullname + '/', artwork))
 
     # now process the local files
     locals = []
@@ -900,22 +1448,63 @@ def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
             already_there = fullname.startswith(MUSIC_DIR)
 
             # is this track cached?
-            log(fullname + ' ', True)
-            valid, info = find_in_cache(cache, index, fullname, s)
+            g_freeze_file_count += 1
+            progress("[%d] %s" % (g_freeze_file_count, fullname))
+            detail(fullname + ' ')
+            valid, info = find_in_cache(index, fullname, s)
+            fingerprint = None
+            if not(info) and not(already_there):
+                # unknown file => maybe it's a known one that has been moved
+                try:
+                    fingerprint = mp3info.GetFingerprint(fullname, s[stat.ST_SIZE])
+                    info = index.find_moved(fingerprint)
+                except IOError:
+                    pass
+                if info:
+                    valid = True
+                    if type(fullname) == types.UnicodeType:
+                        info['original path'] = fullname
+                    else:
+                        info['original path'] = unicode(fullname, sys.getfilesystemencoding(), 'replace')
+                    info['mtime'] = s[stat.ST_MTIME]
+                    set_cache_keys(info)
+                    timer.count("moved files")
+                    detail("[moved] ")
             if valid:
                 info['changed'] = 0
-                log("[cached] ", True)
+                cached_path = info.get('path', None)
+                if not(already_there) and not('fingerprint' in info):
+                    # cache entry from an older version => add the fingerprint,
+                    # so that the file can be found if it's moved later
+                    try:
+                        info['fingerprint'] = fingerprint or mp3info.GetFingerprint(fullname, s[stat.ST_SIZE])
+                    except IOError:
+                        pass
+                timer.count("cached files")
+                detail("[cached] ")
             else:
+                ids = {}
                 if info:
                     # cache entry present, but invalid => save iPod_Control location
+                    # and the IDs of the track
                     path = info['path']
                     changed = 1
+                    for field in ('id', 'dbid'):
+                        if field in info:
+                            ids[field] = info[field]
                 else:
                     path = fullname
                     changed = 2
+                t0 = time.time()
                 info = mp3info.GetAudioFileInfo(fullname)
+                timer.measure("parse", time.time() - t0, fullname)
                 iTunesDB.FillMissingTitleAndArtist(info)
                 info['changed'] = changed
+                info.update(ids)
+                try:
+                    info['fingerprint'] = fingerprint or mp3info.GetFingerprint(fullname, s[stat.ST_SIZE])
+                except IOError:
+                    pass
                 if not already_there:
                     if type(info['path']) == types.UnicodeType:
                         info['original path'] = info['path']
@@ -932,14 +1521,26 @@ def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
                 else:
                     allocator.add(path)
                 info['path'] = path
+                t0 = time.time()
                 info = move_music(fullname, path, info)
+                timer.measure("move", time.time() - t0, fullname)
                 if not info: continue  # something failed
             else:
                 allocator.add(fullname)
-                log("[OK]\n", True)
-
-            # associate artwork to the track
-            info['artwork'] = image_assoc.get(key, artwork)
+                detail("[OK]\n")
+
+            # refresh the index keys if any of the paths changed
+            if not(valid) or (info.get('path', None) != cached_path):
+                set_cache_keys(info)
+
+            # associate artwork to the track; files that are already frozen
+            # have been taken away from their directory's artwork, so they keep
+            # the one they had before, as long as it still exists
+            cached_artwork = info.get('artwork', None)
+            if already_there and valid and cached_artwork and os.path.isfile(cached_artwork):
+                info['artwork'] = cached_artwork
+            else:
+                info['artwork'] = image_assoc.get(key, artwork)
 
             # check for unique artist and album
             check = info.get('artist', None)
@@ -967,9 +1568,9 @@ def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
 
         except:
             g_freeze_error_count += 1
-            log("\n" + " runtime error, traceback follows ".center(79, '-') + "\n")
+            error("\n" + " runtime error, traceback follows ".center(79, '-') + "\n")
             traceback.print_exc(file=Logger)
-            log(79*'-' + "\n")
+            error(79*'-' + "\n")
 
     # if all files in this directory share the same album title, but differ
     # in the artist name, we assume it's a compilation
@@ -986,52 +1587,39 @@ def freeze_dir(cache, index, allocator, playlists=[], base="", artwork=None):
 ## playlist sorting                                                           ##
 ################################################################################
 
-def cmp_lst(a, b, order, empty_pos):
-    a = max(a.get('last played time', 0), a.get('last skipped time', 0))
-    b = max(b.get('last played time', 0), b.get('last skipped time', 0))
-    if not a:
-        if not b: return 0
-        return empty_pos
-    else:
-        if not b: return -empty_pos
-    return order * cmp(a, b)
+# Sort criteria are functions that extract a sort key from a track; None
+# means that the track doesn't have a value for this criterion.
+def key_lst(track):
+    return max(track.get('last played time', 0), track.get('last skipped time', 0)) or None
 
-def cmp_path(a, b, order, empty_pos):
-    return order * trackcmp(a, b)
+key_path = track_sort_key
 
-class cmp_key:
+class key_field:
     def __init__(self, key):
         self.key = key
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, repr(self.key))
-    def __call__(self, a, b, order, empty_pos):
-        if self.key in a:
-            if self.key in b:
-                a = a[self.key]
-                if type(a) in (types.StringType, types.UnicodeType): a = a.lower()
-                b = b[self.key]
-                if type(b) in (types.StringType, types.UnicodeType): b = b.lower()
-                return order * cmp(a, b)
-            else:
-                return -empty_pos
-        else:
-            if self.key in b:
-                return empty_pos
-            else:
-                return 0
+    def __call__(self, track):
+        try:
+            value = track[self.key]
+        except KeyError:
+            return None
+        if type(value) in (types.StringType, types.UnicodeType):
+            value = value.lower()
+        return value
 
 sort_criteria = {
-    'playcount': lambda a,b,o,e: o*cmp(a.get('play count', 0), b.get('play count', 0)),
-    'skipcount': lambda a,b,o,e: o*cmp(a.get('skip count', 0), b.get('skip count', 0)),
-    'startcount': lambda a,b,o,e: o*cmp(a.get('play count', 0) + a.get('skip count', 0), b.get('play count', 0) + b.get('skip count', 0)),
-    'artworkcount': lambda a,b,o,e: o*cmp(a.get('artwork count', 0), b.get('artwork count', 0)),
-    'laststartedtime': cmp_lst,
-    'laststarttime': cmp_lst,
+    'playcount': lambda t: t.get('play count', 0),
+    'skipcount': lambda t: t.get('skip count', 0),
+    'startcount': lambda t: t.get('play count', 0) + t.get('skip count', 0),
+    'artworkcount': lambda t: t.get('artwork count', 0),
+    'laststartedtime': key_lst,
+    'laststarttime': key_lst,
     'lastplaytime': 'last played time',
     'lastskiptime': 'last skipped time',
     'movie': 'movie flag',
     'filesize': 'size',
-    'path': cmp_path,
+    'path': key_path,
 }
 for nc in ('title', 'artist', 'album', 'compilation', 'rating', 'path', \
 'length', 'size', 'track number', 'year', 'bitrate', 'sample rate', 'volume', \
@@ -1040,6 +1628,30 @@ for nc in ('title', 'artist', 'album', 'compilation', 'rating', 'path', \
     sort_criteria[nc.replace(' ', '').lower()] = nc
 
 
+# Descending criteria are folded into the same tuple key as ascending ones by
+# inverting the key values: numbers are negated, strings and tuples turn into
+# tuples of inverted elements, terminated by a marker that is greater than
+# anything else (so that a prefix sorts after the longer value).
+class _KeyEnd:
+    def __lt__(self, other): return False
+    def __le__(self, other): return isinstance(other, _KeyEnd)
+    def __eq__(self, other): return isinstance(other, _KeyEnd)
+    def __ne__(self, other): return not isinstance(other, _KeyEnd)
+    def __gt__(self, other): return not isinstance(other, _KeyEnd)
+    def __ge__(self, other): return True
+KeyEnd = _KeyEnd()
+
+def invert_key(value):
+    t = type(value)
+    if t in (types.IntType, types.LongType, types.FloatType, types.BooleanType):
+        return -value
+    if t in (types.StringType, types.UnicodeType):
+        return tuple([-ord(c) for c in value]) + (KeyEnd,)
+    if t == types.TupleType:
+        return tuple(map(invert_key, value)) + (KeyEnd,)
+    return value
+
+
 re_sortspec = re.compile(r'^([<>+-]*)(.*?)([<>+-]*)$')
 class SSParseError: pass
 
@@ -1066,7 +1678,7 @@ class SortSpec:
         except KeyError:
             raise SSParseError, "unknown sort criterion `%s'" % text
         if type(criterion) == types.StringType:
-            criterion = cmp_key(criterion)
+            criterion = key_field(criterion)
         modifiers = m.group(1) + m.group(3)
         order = 1
         if '-' in modifiers: order = -1
@@ -1074,17 +1686,28 @@ class SortSpec:
         if '<' in modifiers: empty_pos = 1
         return (criterion, order, empty_pos)
 
-    def _cmp(self, a, b):
-        for cmp_func, order, empty_pos in self.criteria:
-            res = cmp_func(self.tracks[a], self.tracks[b], order, empty_pos)
-            if res: return res
-        return cmp(a, b)
+    # turn the criteria into a single function that computes a tuple sort key
+    # for a track; empty values are placed according to their modifier,
+    # independent from the sort order
+    def compile(self):
+        criteria = [(extract, order < 0, empty_pos) for extract, order, empty_pos in self.criteria]
+        def sort_key(track):
+            key = []
+            for extract, descending, empty_pos in criteria:
+                value = extract(track)
+                if value is None:
+                    key.append((empty_pos, None))
+                elif descending:
+                    key.append((0, invert_key(value)))
+                else:
+                    key.append((0, value))
+            return tuple(key)
+        return sort_key
 
     def sort(self, tracks):
-        self.tracks = tracks
-        index = list(range(len(self.tracks)))
-        index.sort(self._cmp)
-        del self.tracks
+        keys = map(self.compile(), tracks)
+        index = range(len(tracks))
+        index.sort(key=keys.__getitem__)
         return [tracks[i] for i in index]
 
     def __add__(self, other):
@@ -1099,43 +1722,71 @@ class SortSpec:
 ## playlist processing                                                        ##
 ################################################################################
 
-def add_scripted_playlist(db, tracklist, list_name, include, exclude, shuffle=False, changemask=0, sort=None):
-    if not(list_name) or not(include or changemask) or not(tracklist):
+def add_scripted_playlists(db, tracklist, listspecs):
+    if not(listspecs) or not(tracklist):
         return
-    tracks = []
-    log("Processing playlist `%s': " % iTunesDB.kill_unicode(list_name), True)
+
+    # compile the include and exclude patterns of all playlists into a single
+    # pattern set, tagged with the playlist number and the pattern type
+    patterns = pathmatch.PatternSet()
+    changemasks = []
+    for n in xrange(len(listspecs)):
+        list_name, include, exclude, shuffle, changemask, sort, seed = listspecs[n]
+        for pattern in include:
+            patterns.add(pattern, (n, True))
+        for pattern in exclude:
+            patterns.add(pattern, (n, False))
+        if changemask:
+            changemasks.append((n, changemask))
+
+    # assign the tracks to the playlists in a single pass
+    members = [[] for listspec in listspecs]
     for track in tracklist:
         if not 'original path' in track:
             continue  # we don't know the real name of this file, so skip it
         name = track['original path'].encode(sys.getfilesystemencoding(), 'replace').lower()
-        ok = changemask & track.get('changed', 0)
-        for pattern in include:
-            if fnmatch.fnmatch(name, pattern):
-                ok = True
-                break
-        for pattern in exclude:
-            if fnmatch.fnmatch(name, pattern):
-                ok = False
-                break
-        if ok:
-            tracks.append(track)
-    log("%d tracks\n" % len(tracks))
+        changed = track.get('changed', 0)
+        selected = {}
+        if changed:
+            for n, changemask in changemasks:
+                if changemask & changed:
+                    selected[n] = True
+        matches = patterns.match(name)
+        for n, include in matches:
+            if include:
+                selected[n] = True
+        for n, include in matches:
+            if not include:
+                selected.pop(n, None)
+        for n in selected:
+            members[n].append(track)
+
+    for n in xrange(len(listspecs)):
+        list_name, include, exclude, shuffle, changemask, sort, seed = listspecs[n]
+        add_scripted_playlist(db, members[n], list_name, shuffle, sort, seed)
+
+
+def add_scripted_playlist(db, tracks, list_name, shuffle=False, sort=None, seed=None):
+    log("Processing playlist `%s': %d tracks\n" % (iTunesDB.kill_unicode(list_name), len(tracks)))
     if not tracks:
         return
     if shuffle == 1:
-        shuffle = BalancedShuffle()
+        shuffle = BalancedShuffle(seed)
         for info in tracks:
             shuffle.add(info.get('original path', None) or info.get('path', "???"), info)
         tracks = shuffle.shuffle()
     if shuffle == 2:
-        random.shuffle(tracks)
+        if seed is None:
+            random.shuffle(tracks)
+        else:
+            random.Random(seed).shuffle(tracks)
     if sort:
         tracks = sort.sort(tracks)
     db.add_playlist(tracks, list_name)
 
 
-def process_m3u(db, tracklist, index, filename, skip_album_playlists):
-    if not(filename) or not(tracklist):
+def process_m3u(db, index, filename, skip_album_playlists):
+    if not(filename) or not(len(index)):
         return
     basedir, list_name = os.path.split(filename)
     list_name = unicode(os.path.splitext(list_name)[0], sys.getfilesystemencoding(), 'replace')
@@ -1143,7 +1794,7 @@ def process_m3u(db, tracklist, index, filename, skip_album_playlists):
     try:
         f = open(filename, "r")
     except IOError, e:
-        log("ERROR: cannot open `%s': %s\n" % (filename, e.strerror))
+        error("ERROR: cannot open `%s': %s\n" % (filename, e.strerror))
     tracks = []
 
     # collect all tracks
@@ -1153,7 +1804,7 @@ def process_m3u(db, tracklist, index, filename, skip_album_playlists):
             continue  # comment or EXTM3U line
         line = os.path.normpath(os.path.join(basedir, line)).replace("\\", "/").lower()
         try:
-            tracks.append(tracklist[index[line]])
+            tracks.append(index[line])
         except KeyError:
             continue  # file not found -> sad, but not fatal
     f.close()
@@ -1173,16 +1824,7 @@ def process_m3u(db, tracklist, index, filename, skip_album_playlists):
                 ok = False  # "all known tracks are from the same album, how sad"
         if not ok:
             # now check if this playlist really covers the _whole_ album
-            ok = len(tracks)
-            for info in tracklist:
-                try:
-                    if info.get('album', None) == ref_album:
-                        ok -= 1
-                        if ok < 0: break
-                except (TypeError, UnicodeDecodeError):
-                    # old (<0.3.0) cache files contain non-unicode information
-                    # for ID3v1 tags which can cause trouble here, so ...
-                    continue
+            ok = len(tracks) - index.album_count(ref_album)
         if not(ok) :
             log("album playlist, discarding.\n")
             return
@@ -1194,27 +1836,70 @@ def process_m3u(db, tracklist, index, filename, skip_album_playlists):
     db.add_playlist(tracks, list_name)
 
 
+class DirectoryNode:
+    def __init__(self, path=()):
+        self.path = path
+        self.children = {}
+        self.tracks = []
+
 def make_directory_playlists(db, tracklist):
     log("Processing directory playlists ...\n")
-    dirs = {}
+
+    # build a trie of all directories that contain tracks
+    root = DirectoryNode()
     for track in tracklist:
         path = track.get('original path', None)
         if not path: continue
-        for dir in path.split('/')[:-1]:
+        path = path.split('/')
+        node = root
+        for dir in path[:-1]:
             if not dir: continue
-            if dir in dirs:
-                dirs[dir].append(track)
-            else:
-                dirs[dir] = [track]
-    dirlist = dirs.keys()
-    dirlist.sort(fncmp)
+            try:
+                node = node.children[dir]
+            except KeyError:
+                child = DirectoryNode(node.path + (dir,))
+                node.children[dir] = child
+                node = child
+        node.tracks.append((track_sort_key(track)[-1], track))
+
+    # walk the trie in path order (subdirectories first, then files); the
+    # tracks of every directory's subtree form a contiguous range of the result
+    ordered = []
+    ranges = []
+    def walk(node):
+        start = len(ordered)
+        children = [(natural_key(name), name, child) for name, child in node.children.iteritems()]
+        children.sort(key=lambda x: x[:2])
+        for dummy, name, child in children:
+            walk(child)
+        node.tracks.sort(key=lambda x: x[0])
+        ordered.extend([track for dummy, track in node.tracks])
+        if node.path:
+            ranges.append((node.path, start, len(ordered)))
+    walk(root)
+
+    # directories with the same name get a playlist each; those are named
+    # after the shortest path suffix that tells them apart
+    by_name = {}
+    for item in ranges:
+        by_name.setdefault(item[0][-1], []).append(item)
+    playlists = []
+    for name, items in by_name.iteritems():
+        depth = 1
+        while len(items) > 1:
+            depth += 1
+            names = dict([(dir_path[-depth:], None) for dir_path, dummy, dummy in items])
+            if (len(names) == len(items)) or (depth >= max([len(dir_path) for dir_path, dummy, dummy in items])):
+                break
+        for path, start, end in items:
+            name = u'/'.join(path[-depth:])
+            playlists.append((natural_key(name), map(natural_key, path), name, start, end))
+    playlists.sort(key=lambda x: x[:2])
 
-    for dir in dirlist:
-        log("Processing playlist `%s': " % iTunesDB.kill_unicode(dir), True)
-        tracks = dirs[dir]
-        tracks.sort(trackcmp)
-        log("%d tracks\n" % len(tracks))
-        db.add_playlist(tracks, dir)
+    for dummy, dummy, name, start, end in playlists:
+        log("Processing playlist `%s': " % iTunesDB.kill_unicode(name), True)
+        log("%d tracks\n" % (end - start))
+        db.add_playlist(ordered[start:end], name)
 
 
 shuffle_options = {
@@ -1247,6 +1932,7 @@ def parse_master_playlist_file():
     shuffle = 0
     changemask = 0
     sort = SortSpec()
+    seed = None
     lineno = 0
     for line in f:
         lineno += 1
@@ -1254,13 +1940,14 @@ def parse_master_playlist_file():
         if not line: continue
         if (line[0] == '[') and (line[-1] == ']'):
             if list_name and (include or changemask):
-                lists.append((list_name, include, exclude, shuffle, changemask, sort))
+                lists.append((list_name, include, exclude, shuffle, changemask, sort, seed))
             include = []
             exclude = []
             list_name = line[1:-1]
             shuffle = False
             changemask = 0
             sort = SortSpec()
+            seed = None
             continue
         try:
             key, value = [x.strip().replace("\\", "/") for x in line.split('=')]
@@ -1268,19 +1955,25 @@ def parse_master_playlist_file():
             continue
         key = key.lower().replace(' ', '_')
         if not value:
-            log("WARNING: In %s:%d: key `%s' without a value\n" % (MASTER_PLAYLIST_FILE, lineno, key))
+            warning("WARNING: In %s:%d: key `%s' without a value\n" % (MASTER_PLAYLIST_FILE, lineno, key))
             continue
         if key == "skip_album_playlists":
-            if list_name: log("WARNING: In %s:%d: global option `%s' inside a playlist\n" % (MASTER_PLAYLIST_FILE, lineno, key))
+            if list_name: warning("WARNING: In %s:%d: global option `%s' inside a playlist\n" % (MASTER_PLAYLIST_FILE, lineno, key))
             skip_album_playlists = yesno(value)
         elif key == "directory_playlists":
-            if list_name: log("WARNING: In %s:%d: global option `%s' inside a playlist\n" % (MASTER_PLAYLIST_FILE, lineno, key))
+            if list_name: warning("WARNING: In %s:%d: global option `%s' inside a playlist\n" % (MASTER_PLAYLIST_FILE, lineno, key))
             directory_playlists = yesno(value)
         elif key == "shuffle":
             try:
                 shuffle = shuffle_options[value.lower()]
             except KeyError:
-                log("WARNING: In %s:%d: invalid value `%s' for shuffle option\n" % (MASTER_PLAYLIST_FILE, lineno, value))
+                warning("WARNING: In %s:%d: invalid value `%s' for shuffle option\n" % (MASTER_PLAYLIST_FILE, lineno, value))
+        elif key == "seed":
+            try:
+                seed = int(value)
+            except ValueError:
+                # use a stable number derived from the text
+                seed = long(md5.md5(value).hexdigest(), 16)
         elif key == "new":
             changemask = (changemask & (~2)) | (yesno(value) << 1)
         elif key == "changed":
@@ -1289,7 +1982,7 @@ def parse_master_playlist_file():
             try:
                 sort = SortSpec(value) + sort
             except SSParseError, e:
-                log("WARNING: In %s:%d: %s\n" % (MASTER_PLAYLIST_FILE, lineno, e))
+                warning("WARNING: In %s:%d: %s\n" % (MASTER_PLAYLIST_FILE, lineno, e))
         elif key in ("include", "exclude"):
             if value[0] == "/":
                 value = value[1:]
@@ -1302,10 +1995,10 @@ def parse_master_playlist_file():
             else:
                 exclude.append(value.lower())
         else:
-            log("WARNING: In %s:%d: unknown key `%s'\n" % (MASTER_PLAYLIST_FILE, lineno, key))
+            warning("WARNING: In %s:%d: unknown key `%s'\n" % (MASTER_PLAYLIST_FILE, lineno, key))
     f.close()
     if list_name and (include or changemask):
-        lists.append((list_name, include, exclude, shuffle, changemask, sort))
+        lists.append((list_name, include, exclude, shuffle, changemask, sort, seed))
     return (skip_album_playlists, directory_playlists, lists)
 
 
@@ -1341,11 +2034,11 @@ def find_good_artwork(files, base):
     return candidates[0][2]  # return the candidate with the best score
 
 
-def GenerateArtwork(model, tracklist):
+def GenerateArtwork(model, tracklist, stage=None):
     # step 0: check PIL availability
     if not iTunesDB.PILAvailable:
-        log("ERROR: Python Imaging Library (PIL) isn't installed, Artwork is disabled.\n")
-        log("       Visit http://www.pythonware.com/products/pil/ to get PIL.\n")
+        error("ERROR: Python Imaging Library (PIL) isn't installed, Artwork is disabled.\n")
+        error("       Visit http://www.pythonware.com/products/pil/ to get PIL.\n")
         return
 
     # step 1: generate an artwork list
@@ -1380,14 +2073,25 @@ def GenerateArtwork(model, tracklist):
         old_cache = ({}, {})
 
     # step 4: generate and save the ArtworkDB
-    artwork_db, new_cache, dbid2mhii = iTunesDB.ArtworkDB(model, artwork_list, cache_data=old_cache)
-    backup(ARTWORK_DB_FILE)
+    timer.begin("artwork")
+    if stage:
+        output_dir = stage.subdir("Artwork")
+    else:
+        output_dir = None
+    artwork_db, new_cache, dbid2mhii = iTunesDB.ArtworkDB(model, artwork_list, cache_data=old_cache, output_dir=output_dir)
+    timer.end(len(artwork_list))
+    if stage:
+        stage.adopt(output_dir, ARTWORK_DIR)
+        target = stage.path(ARTWORK_DB_FILE)
+    else:
+        backup(ARTWORK_DB_FILE)
+        target = ARTWORK_DB_FILE
     try:
-        f = open(ARTWORK_DB_FILE, "wb")
+        f = open(target, "wb")
         f.write(artwork_db)
         f.close()
     except IOError, e:
-        log("FAILED: %s\n" % e.strerror +
+        error("FAILED: %s\n" % e.strerror +
             "ERROR: The ArtworkDB file could not be written. This means that the iPod will\n" +
             "not show any artwork items.\n")
 
@@ -1398,7 +2102,7 @@ def GenerateArtwork(model, tracklist):
         f.close()
         delete(OLDNAME(ARTWORK_CACHE_FILE), True)
     except (IOError, EOFError, cPickle.PickleError):
-        log("ERROR: can't save the artwork cache\n")
+        error("ERROR: can't save the artwork cache\n")
 
     # step 6: update the 'mhii link' field
     for track in tracklist:
@@ -1414,7 +2118,53 @@ def GenerateArtwork(model, tracklist):
 ## FREEZE and UPDATE action                                                   ##
 ################################################################################
 
-def Freeze(CacheInfo=None, UpdateOnly=False):
+# Update runs usually only change the play statistics. In that case, the
+# existing iTunesDB is patched in place: only the changed fixed-width mhit
+# fields are rewritten, and only the pages of the file that actually differ
+# are written back. If anything else changed (tracks, playlists), this
+# returns (None, db) and the caller has to do a full rebuild.
+DB_PAGE_SIZE = 4096
+
+def patch_database(db, tracklist):
+    try:
+        f = open(DB_FILE, "rb")
+        old_db = f.read()
+        f.close()
+    except IOError:
+        return (None, db)
+    new_db, changed = iTunesDB.PatchPlayStatistics(old_db, tracklist, db.playlist_section())
+    if not new_db:
+        log("Full iTunesDB rebuild required: %s.\n" % changed)
+        return (None, db)
+    # the old database will be modified, so make sure a backup exists
+    if not os.path.exists(DB_FILE + ".repear_backup"):
+        try:
+            shutil.copyfile(DB_FILE, DB_FILE + ".repear_backup")
+        except (IOError, OSError), e:
+            warning("WARNING: Cannot backup `%s': %s\n" % (DB_FILE, e))
+    log("Patching play statistics of %d tracks into the existing iTunesDB.\n" % changed)
+    timer.count("tracks patched", changed)
+    return (old_db, new_db)
+
+
+def write_changed_pages(filename, old, new):
+    if len(old) != len(new):
+        raise IOError, (0, "database size changed")
+    f = open(filename, "r+b")
+    pages = 0
+    try:
+        for pos in xrange(0, len(new), DB_PAGE_SIZE):
+            page = new[pos:pos+DB_PAGE_SIZE]
+            if old[pos:pos+DB_PAGE_SIZE] != page:
+                f.seek(pos)
+                f.write(page)
+                pages += 1
+    finally:
+        f.close()
+    return pages
+
+
+def Freeze(CacheInfo=None, UpdateOnly=False, AllowPatch=True):
     global g_freeze_error_count
     if not CacheInfo: CacheInfo = load_cache((None, []))
     state, cache = CacheInfo
@@ -1434,18 +2184,27 @@ NOTE: The database is already frozen.
     # allocate the filename allocator
     if not UpdateOnly:
         log("Scanning for present files ...\n", True)
+        timer.begin("allocator scan")
         try:
-            allocator = Allocator(MUSIC_DIR[:-1])
+            allocator = Allocator(MUSIC_DIR[:-1], expected=len(cache))
         except (IOError, OSError):
-            log("FATAL: can't read or write the music directory!\n")
+            timer.end()
+            error("FATAL: can't read or write the music directory!\n")
             return
+        timer.end()
+        if allocator.overfull():
+            log("NOTE: %d music directories hold more than %d files, consider running\n" % \
+                (len(allocator.overfull()), allocator.files_per_dir) +
+                "      the `rebalance' action to speed up file access on the iPod.\n")
 
     # parse the master playlist setup file
     skip_album_playlists, directory_playlists, master_playlists = parse_master_playlist_file()
 
     # index the track cache
     log("Indexing track cache ...\n", True)
-    index = make_cache_index(cache)
+    timer.begin("cache index")
+    index = CacheIndex(cache)
+    timer.end(len(cache))
 
     # allocate scrobbler
     scrobbler = scrobble.Scrobbler()
@@ -1456,7 +2215,7 @@ NOTE: The database is already frozen.
         scrobbler = None
 
     # import Play Counts information
-    if ImportPlayCounts(cache, index, scrobbler):
+    if ImportPlayCounts(index, scrobbler):
         # save cache and delete the play counts file afterwards
         save_cache((state, cache))
         delete(CONTROL_DIR + "Play Counts", may_fail=True)
@@ -1465,25 +2224,33 @@ NOTE: The database is already frozen.
     if scrobbler and scrobbler.queue:
         old_count = len(scrobbler.queue)
         log("Scrobbling %d track(s) ... " % old_count, True)
+        timer.begin("scrobble")
         try:
             scrobbler.scrobble()
             log("OK.\n")
         except scrobble.ScrobbleError, e:
-            log("%s\n" % e)
+            error("%s\n" % e)
         except KeyboardInterrupt:
             log("interrupted by user.\n")
         new_count = len(scrobbler.queue)
+        timer.end(old_count - new_count)
         log("%s track(s) scrobbled, %d track(s) still in queue.\n" % (old_count - new_count, new_count))
         if scrobbler.save(SCROBBLE_QUEUE_FILE):
             delete(OLDNAME(SCROBBLE_QUEUE_FILE), True)
         else:
-            log("Error writing scrobbler state file.\n")
+            error("Error writing scrobbler state file.\n")
 
     # now go for the real thing
     playlists = []
     if not UpdateOnly:
         log("Searching for playable files ...\n", True)
-        tracklist = freeze_dir(cache, index, allocator, playlists)
+        timer.begin("scan")
+        tracklist = freeze_dir(index, allocator, playlists)
+        # files that are already frozen are found in the order of their
+        # iPod_Control names; put all tracks into the order of the original
+        # directory tree, so that the database doesn't depend on those names
+        tracklist.sort(key=track_sort_key)
+        timer.end(len(tracklist))
         log("Scan complete: %d tracks found, %d error(s).\n" % (len(tracklist), g_freeze_error_count))
 
         # cache save checkpoint
@@ -1509,7 +2276,7 @@ NOTE: The database is already frozen.
         if model:
             model = model.strip().lower()
             if not(model in iTunesDB.ImageFormats):
-                log("\nWARNING: model `%s' unrecognized, skipping Artwork generation.\n" % model)
+                warning("\nWARNING: model `%s' unrecognized, skipping Artwork generation.\n" % model)
             else:
                 try:
                     f = open(MODEL_FILE, "w")
@@ -1523,106 +2290,171 @@ NOTE: The database is already frozen.
     else:
         model = None
 
-    # generate track IDs
-    if not UpdateOnly:
-        iTunesDB.GenerateIDs(tracklist)
-
-    # generate the artwork list
-    if model and not(UpdateOnly):
-        log("\nProcessing Artwork ...\n", True)
-        GenerateArtwork(model, tracklist)
-
-    # build the database
-    log("\nCreating iTunesDB ...\n", True)
-    db = iTunesDB.iTunesDB(tracklist, name="%s %s"%(__title__, __version__))
-
-    # save the tracklist as the cache for the next run
-    save_cache((state, tracklist))
-
-    # add playlists according to the master playlist file
-    for listspec in master_playlists:
-        add_scripted_playlist(db, tracklist, *listspec)
-
-    # process all m3u playlists
-    if playlists:
-        log("Updating track index ...\n", True)
-        index = make_cache_index(tracklist)
-    for plist in playlists:
-        process_m3u(db, tracklist, index, plist, skip_album_playlists)
-
-    # create directory playlists
-    if directory_playlists:
-        make_directory_playlists(db, tracklist)
+    # in staging mode, all output files are built locally first
+    stage = None
+    if Options['stage']:
+        try:
+            stage = Stage()
+        except (IOError, OSError), e:
+            warning("WARNING: can't create a staging directory (%s), writing to the iPod directly.\n" % e)
 
-    # finish iTunesDB and apply hash stuff
-    log("Finalizing iTunesDB ...\n")
-    db = db.finish()
-    fwids = hash58.GetFWIDs()
     try:
-        f = open(FWID_FILE, "r")
-        fwid = f.read().strip().upper()
-        f.close()
-        if len(fwid) != 16:
-            fwid = None
-    except IOError:
-        fwid = None
-    store_fwid = False
-    if fwid:
-        # preferred FWID stored on iPod
-        if fwids and not(fwid in fwids):
-            log("WARNING: Stored serial number doesn't match any connected iPod!\n")
-    else:
-        # auto-detect FWID
-        if fwids:
-            fwid = fwids[0]
-            store_fwid = (len(fwids) == 1)
-            if not store_fwid:
-                log("WARNING: Multiple iPods are connected. If the iPod you are trying to freeze is\n" +
-                    "         a recent model, it might not play anything. Please try again with the\n" +
-                    "         other iPod unplugged.\n")
-        else:
-            log("WARNING: Could not determine your iPod's serial number. If it's a recent model,\n" +
-                "         it will likely not play anything!\n")
-    if fwid:
-        db = hash58.UpdateHash(db, fwid)
-    if store_fwid:
+        # generate IDs for new tracks
+        if not UpdateOnly:
+            iTunesDB.GenerateIDs(tracklist)
+
+        # generate the artwork list
+        if model and not(UpdateOnly):
+            log("\nProcessing Artwork ...\n", True)
+            GenerateArtwork(model, tracklist, stage)
+
+        # build the database
+        log("\nCreating iTunesDB ...\n", True)
+        timer.begin("database build")
+        jobs = Options['jobs']
+        if jobs < 1:
+            jobs = iTunesDB.cpu_count()
+        db = iTunesDB.iTunesDB(tracklist, name="%s %s"%(__title__, __version__),
+                               dbid=iTunesDB.ReadDatabaseID(DB_FILE), jobs=jobs)
+        timer.end(len(tracklist))
+
+        # save the tracklist as the cache for the next run
+        save_cache((state, tracklist))
+
+        # add playlists according to the master playlist file
+        timer.begin("playlists")
+        add_scripted_playlists(db, tracklist, master_playlists)
+
+        # process all m3u playlists
+        if playlists:
+            log("Updating track index ...\n", True)
+            index.build(tracklist)
+        for plist in playlists:
+            process_m3u(db, index, plist, skip_album_playlists)
+
+        # create directory playlists
+        if directory_playlists:
+            make_directory_playlists(db, tracklist)
+        timer.end(len(master_playlists) + len(playlists))
+
+        # in update mode, try to patch the play statistics into the old database
+        # instead of writing a new one
+        old_db = None
+        if UpdateOnly and AllowPatch and not(stage):
+            timer.begin("database patch")
+            old_db, new_db = patch_database(db, tracklist)
+            if old_db:
+                db.close()
+                db = new_db
+            timer.end(len(tracklist))
+
+        # finish iTunesDB and apply hash stuff
+        log("Finalizing iTunesDB ...\n")
+        timer.begin("database finish")
+        if not old_db:
+            db = db.finish()
+        timer.end()
+        fwids = hash58.GetFWIDs()
         try:
-            f = open(FWID_FILE, "w")
-            f.write(fwid)
+            f = open(FWID_FILE, "r")
+            fwid = f.read().strip().upper()
             f.close()
+            if len(fwid) != 16:
+                fwid = None
         except IOError:
-            pass
+            fwid = None
+        store_fwid = False
+        if fwid:
+            # preferred FWID stored on iPod
+            if fwids and not(fwid in fwids):
+                warning("WARNING: Stored serial number doesn't match any connected iPod!\n")
+        else:
+            # auto-detect FWID
+            if fwids:
+                fwid = fwids[0]
+                store_fwid = (len(fwids) == 1)
+                if not store_fwid:
+                    warning("WARNING: Multiple iPods are connected. If the iPod you are trying to freeze is\n" +
+                        "         a recent model, it might not play anything. Please try again with the\n" +
+                        "         other iPod unplugged.\n")
+            else:
+                warning("WARNING: Could not determine your iPod's serial number. If it's a recent model,\n" +
+                    "         it will likely not play anything!\n")
+        if fwid:
+            timer.begin("hash")
+            db = hash58.UpdateHash(db, fwid)
+            timer.end()
+        if store_fwid:
+            try:
+                f = open(FWID_FILE, "w")
+                f.write(fwid)
+                f.close()
+            except IOError:
+                pass
 
-    # write iTunesDB
-    write_ok = True
-    backup(DB_FILE)
-    try:
-        f = open(DB_FILE, "wb")
-        f.write(db)
-        f.close()
-    except IOError, e:
-        write_ok = False
-        log("FAILED: %s\n" % e.strerror +
-            "ERROR: The iTunesDB file could not be written. This means that the iPod will\n" +
-            "not play anything.\n")
-
-    # write iPod shuffle stuff (if necessary)
-    if os.path.exists(CONTROL_DIR + "iTunesSD"):
-        backup(CONTROL_DIR + "iTunesSD")
-        log("Creating iTunesSD ... ", True)
-        db = iTunesDB.iTunesSD(tracklist)
+        # write iTunesDB
+        write_ok = True
+        if stage:
+            target = stage.path(DB_FILE)
+        elif not old_db:
+            backup(DB_FILE)
+            target = DB_FILE
+        timer.begin("write iTunesDB")
         try:
-            f = open(CONTROL_DIR + "iTunesSD", "wb")
-            f.write(db)
-            f.close()
-            log("\n")
+            if old_db:
+                pages = write_changed_pages(DB_FILE, old_db, db)
+                log("%d of %d pages of the iTunesDB rewritten.\n" % (pages, (len(db) + DB_PAGE_SIZE - 1) / DB_PAGE_SIZE))
+            else:
+                f = open(target, "wb")
+                f.write(db)
+                f.close()
         except IOError, e:
             write_ok = False
-            log("FAILED: %s\n" % e.strerror +
-                "ERROR: The iTunesSD file could not be written. This means that the iPod will\n" +
+            error("FAILED: %s\n" % e.strerror +
+                "ERROR: The iTunesDB file could not be written. This means that the iPod will\n" +
                 "not play anything.\n")
-        delete(CONTROL_DIR + "iTunesShuffle")
-        delete(CONTROL_DIR + "iTunesPState")
+        timer.end()
+
+        # write iPod shuffle stuff (if necessary)
+        shuffle = os.path.exists(CONTROL_DIR + "iTunesSD")
+        if shuffle:
+            if stage:
+                target = stage.path(CONTROL_DIR + "iTunesSD")
+            else:
+                backup(CONTROL_DIR + "iTunesSD")
+                target = CONTROL_DIR + "iTunesSD"
+            log("Creating iTunesSD ... ", True)
+            timer.begin("iTunesSD")
+            try:
+                f = open(target, "wb")
+                iTunesDB.WriteiTunesSD(f, tracklist)
+                f.close()
+                log("\n")
+            except IOError, e:
+                write_ok = False
+                error("FAILED: %s\n" % e.strerror +
+                    "ERROR: The iTunesSD file could not be written. This means that the iPod will\n" +
+                    "not play anything.\n")
+            timer.end(len(tracklist))
+            if not stage:
+                reset_shuffle_state()
+
+        # copy the staged files to the iPod, but only if all of them are complete
+        if stage and write_ok:
+            log("Copying database files to the iPod ... ", True)
+            timer.begin("install")
+            if stage.install():
+                log("OK.\n")
+                if shuffle:
+                    reset_shuffle_state()
+            else:
+                write_ok = False
+            timer.end(len(stage.files))
+        elif stage:
+            error("ERROR: The database files on the iPod have been left untouched.\n")
+    finally:
+        if stage:
+            stage.cleanup()
 
     # generate statistics
     if write_ok:
@@ -1658,27 +2490,83 @@ NOTE: The database is already unfrozen.
 """)
 
     log("Moving tracks back to their original locations ...\n")
-    success = 0
-    failed = 0
+    plan = MovePlan("unfreeze")
     for info in cache:
         src = printable(info.get('path', ""))
         dest = printable(info.get('original path', ""))
         if not src:
-            log("ERROR: track lacks path attribute\n")
+            error("ERROR: track lacks path attribute\n")
             continue
         if not dest:
             continue  # no original path
-        log("%s " % dest)
-        if move_file(src, dest):
-            failed += 1
-        else:
-            success += 1
+        plan.add(src, dest)
+    if Options['dry_run']:
+        plan.dry_run()
+        return
+    success, failed = plan.execute()
     log("Operation complete: %d tracks total, %d moved back, %d failed.\n" % \
         (len(cache), success, failed))
     log("\nYou can now manage the music files on your iPod.\n")
     save_cache(("unfrozen", cache))
 
 
+################################################################################
+## REBALANCE action                                                           ##
+################################################################################
+
+def Rebalance(CacheInfo=None):
+    if not CacheInfo: CacheInfo = load_cache((None, None))
+    state, cache = CacheInfo
+
+    if not(state) or (cache is None):
+        fatal("can't rebalance: rePear cache is missing or broken")
+    if state!="frozen" and not(Options['force']):
+        confirm("""
+NOTE: The database is not frozen, so there is nothing to rebalance.
+""")
+
+    log("Scanning for present files ...\n", True)
+    try:
+        allocator = Allocator(MUSIC_DIR[:-1], expected=len(cache))
+    except (IOError, OSError):
+        fatal("can't read or write the music directory!")
+    log("%d files in %d directories, target geometry is %d directories with up to\n%d files each.\n" % \
+        (len(allocator), len(allocator.files), allocator.max_dirs, allocator.files_per_dir))
+    if not allocator.overfull():
+        log("No overfull directories found, nothing to do.\n")
+        return
+
+    # move the excess files out of overfull directories; these are plain
+    # renames on the same volume, so they are cheap
+    log("Moving files out of overfull directories ...\n", True)
+    moved = 0
+    failed = 0
+    for info in cache:
+        src = printable(info.get('path', ""))
+        if not(src) or not(allocator.contains(src)) or not(allocator.excess(src)):
+            continue
+        dest = allocator.allocate() + os.path.splitext(src)[1]
+        try:
+            os.rename(src, dest)
+        except OSError, e:
+            error("ERROR: can't move `%s' to `%s': %s\n" % (src, dest, e.strerror))
+            allocator.remove(dest)
+            failed += 1
+            continue
+        allocator.remove(src)
+        info['path'] = dest
+        set_cache_keys(info)
+        moved += 1
+    log("Operation complete: %d files moved, %d failed.\n" % (moved, failed))
+
+    # the cache needs to be saved in any case, because the files are already
+    # at their new locations; the database must follow suit
+    save_cache((state, cache))
+    if moved and (state == "frozen"):
+        log("\n")
+        Freeze((state, cache), UpdateOnly=True, AllowPatch=False)
+
+
 ################################################################################
 ## the configuration actions                                                  ##
 ################################################################################
@@ -1710,7 +2598,7 @@ def ConfigFWID():
     # exactly one FWID detected
     log("Serial number detected: %s\n" % fwids[0])
     if fwid and (fwid != fwids[0]):
-        log("Warning: This serial number is different from the one that has been stored on\n" + \
+        warning("Warning: This serial number is different from the one that has been stored on\n" + \
             "         the iPod (%s). Storing the new FWID anyway.\n" % fwid)
     fwid = fwids[0]
     if not fwid:
@@ -1721,7 +2609,7 @@ def ConfigFWID():
         f.close()
         log("FWID saved.\n\n")
     except IOError:
-        log("Error saving the FWID.\n\n")
+        error("Error saving the FWID.\n\n")
 
 
 models = (
@@ -1773,7 +2661,7 @@ def ConfigModel():
             f.close()
             log("Model set to `%s'.\n\n" % models[answer][-1])
         except IOError:
-            log("Error: cannot set model.\n\n")
+            error("Error: cannot set model.\n\n")
     else:
         delete(MODEL_FILE, True)
         log("Model set to `other'.\n\n")
@@ -1857,7 +2745,7 @@ def ConfigScrobble():
         else:
             log("Scrobbling disabled.\n\n")
     except IOError:
-        log("Error updating the scrobble config file.\n\n")
+        error("Error updating the scrobble config file.\n\n")
 
 
 def ConfigAll():
@@ -1904,6 +2792,56 @@ WARNING: The database is currently frozen. If you reset the cache now, you will
 ## the main function                                                          ##
 ################################################################################
 
+def run_action(action):
+    if   action=="auto":         Auto()
+    elif action=="freeze":       Freeze()
+    elif action=="unfreeze":     Unfreeze()
+    elif action=="update":       Freeze(UpdateOnly=True)
+    elif action=="rebalance":    Rebalance()
+    elif action=="dissect":      Dissect()
+    elif action=="reset":        Reset()
+    elif action=="config":       ConfigAll()
+    elif action=="cfg-fwid":     ConfigFWID()
+    elif action=="cfg-model":    ConfigModel()
+    elif action=="cfg-scrobble": ConfigScrobble()
+    else:
+        log("Unknown action, don't know what to do.\n")
+
+
+# runs func(*args) under the profiler selected by the --profile-mode option,
+# saves the statistics and logs the top hot spots
+def run_profiled(func, *args):
+    filename = Options['profile']
+    if Options['profile_mode'] == "sample":
+        import profiler
+        prof = profiler.SamplingProfiler()
+        prof.start()
+        try:
+            func(*args)
+        finally:
+            prof.stop()
+            log("\n" + " sampling profile, top 25 functions ".center(79, '-') + "\n")
+            prof.print_stats(InfoLogger, 25)
+            try:
+                prof.dump_stats(filename)
+                log("Full profile written to `%s'\n" % filename)
+            except IOError, e:
+                error("ERROR: can't write profile `%s': %s\n" % (filename, e.strerror))
+    else:
+        prof = profile.Profile()
+        try:
+            prof.runcall(func, *args)
+        finally:
+            log("\n" + " profile, top 25 functions by cumulative time ".center(79, '-') + "\n")
+            stats = pstats.Stats(prof, stream=InfoLogger)
+            stats.sort_stats('cumulative').print_stats(25)
+            try:
+                prof.dump_stats(filename)
+                log("Profile statistics written to `%s'\n" % filename)
+            except IOError, e:
+                error("ERROR: can't write profile `%s': %s\n" % (filename, e.strerror))
+
+
 class MyOptionParser(optparse.OptionParser):
     def format_help(self, formatter=None):
         models = iTunesDB.ImageFormats.keys()
@@ -1917,6 +2855,7 @@ actions:
   freeze       move all music files into the iPod's library
   unfreeze     move music files back to their original location
   update       update the frozen database without scanning for new files
+  rebalance    move files out of overfull iPod_Control/Music directories
   dissect      generate an Artist/Album/Title directory structure
   reset        clear rePear's metadata cache
   cfg-fwid     determine the iPod's serial number and save it
@@ -1929,6 +2868,8 @@ If no action is specified, rePear automatically determines which of the
 """
 
 if __name__ == "__main__":
+    if iTunesDB.multiprocessing:
+        iTunesDB.multiprocessing.freeze_support()
     parser = MyOptionParser(version=__version__,
              usage="%prog [options] [<action>]")
     parser.add_option("-r", "--root", action="store", default=None, metavar="PATH",
@@ -1945,11 +2886,35 @@ if __name__ == "__main__":
                       help="specify playlist config file")
     parser.add_option("-s", "--scrobble", action="store", default=None, metavar="FILE",
                       help="specify scrobble config file")
+    parser.add_option("--stage", action="store_true", default=False,
+                      help="build the database files locally and copy them to the iPod in one go")
+    parser.add_option("-n", "--dry-run", action="store_true", default=False,
+                      help="only show which files unfreeze or dissect would move")
+    parser.add_option("-j", "--jobs", action="store", type="int", default=1, metavar="N",
+                      help="build the iTunesDB with N processes (0 = one per CPU core)")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="show the details for every file on the console, too")
+    parser.add_option("--profile", action="store", default=None, metavar="FILE",
+                      help="profile the action and write the statistics to FILE (optional, default: repear.prof)")
+    parser.add_option("--profile-mode", action="store", default="cprofile", metavar="MODE",
+                      choices=("cprofile", "sample"),
+                      help="profiler to use: `cprofile' (exact) or `sample' (low overhead)")
     if os.name == 'nt':
         parser.add_option("--nowait", action="store_true", default=False,
                           help="don't wait for keypress when finished")
-    (opts, args) = parser.parse_args()
+    # optparse doesn't support optional option arguments, so a --profile
+    # that isn't followed by a file name gets an empty one
+    argv = sys.argv[1:]
+    for i in xrange(len(argv)):
+        if argv[i] != "--profile":
+            continue
+        if (i + 1 >= len(argv)) or argv[i+1].startswith("-") \
+        or (argv[i+1].strip().lower() in ACTIONS):
+            argv[i] = "--profile="
+    (opts, args) = parser.parse_args(argv)
     Options = opts.__dict__
+    if Options['verbose']:
+        console_level = LOG_DETAIL
 
     if len(args)>1: parser.error("too many arguments")
     if args:
@@ -1959,17 +2924,17 @@ if __name__ == "__main__":
     if action == "help":
         parser.print_help()
         sys.exit(0)
-    if not action in (
-        'auto', 'freeze', 'unfreeze', 'update', 'dissect', 'reset', \
-        'config', 'cfg-fwid', 'cfg-scrobble', 'cfg-model'
-    ):
+    if not action in ACTIONS:
         parser.error("invalid action `%s'" % action)
 
     oldcwd = os.getcwd()
     open_log()
+    if Options['profile'] is not None:
+        Options['profile'] = os.path.abspath(Options['profile'] or \
+                             (os.path.splitext(Options['log'])[0] + ".prof"))
     log("%s\n%s\n\n" % (banner, len(banner) * '-'))
     if not logfile:
-        log("WARNING: can't open log file `%s', logging disabled\n\n" % Options['log'])
+        warning("WARNING: can't open log file `%s', logging disabled\n\n" % Options['log'])
     goto_root_dir()
 
     if Options['playlist']:
@@ -1989,18 +2954,10 @@ if __name__ == "__main__":
 
     log("\n")
     try:
-        if   action=="auto":         Auto()
-        elif action=="freeze":       Freeze()
-        elif action=="unfreeze":     Unfreeze()
-        elif action=="update":       Freeze(UpdateOnly=True)
-        elif action=="dissect":      Dissect()
-        elif action=="reset":        Reset()
-        elif action=="config":       ConfigAll()
-        elif action=="cfg-fwid":     ConfigFWID()
-        elif action=="cfg-model":    ConfigModel()
-        elif action=="cfg-scrobble": ConfigScrobble()
+        if Options['profile']:
+            run_profiled(run_action, action)
         else:
-            log("Unknown action, don't know what to do.\n")
+            run_action(action)
         code = 0
     except SystemExit, e:
         sys.exit(e.code)
@@ -2008,8 +2965,8 @@ if __name__ == "__main__":
         log("\n" + 79*'-' + "\n\nAction aborted by user.\n")
         code = 2
     except:
-        log("\n" + 79*'-' + "\n\nOOPS -- rePear crashed!\n\n")
+        error("\n" + 79*'-' + "\n\nOOPS -- rePear crashed!\n\n")
         traceback.print_exc(file=Logger)
-        log("\nPlease inform the author of rePear about this crash by sending the\nrepear.log file.\n")
+        error("\nPlease inform the author of rePear about this crash by sending the\nrepear.log file.\n")
         code = 1
     quit(code)
@@ -17,7 +17,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import sys, urllib, urllib2, re, time, md5, types, fnmatch, os
+import sys, urllib, urllib2, re, time, md5, types, os
+import pathmatch
 
 try:
     import repear
@@ -44,7 +45,7 @@ class Scrobbler:
     def __init__(self, user=None, password=None):
         self.user = user
         self.password = password
-        self.excludes = []
+        self.excludes = pathmatch.PatternSet()
         self.queue = []
         self.index = {}
 
@@ -74,7 +75,7 @@ class Scrobbler:
                         if value[-1] != "/":
                             value += "/"
                         value += "*"
-                    self.excludes.append(value.lower())
+                    self.excludes.add(value.lower())
             f.close()
         except IOError:
             return False
@@ -114,10 +115,8 @@ class Scrobbler:
         if self.excludes and path:
             if type(path) == types.UnicodeType:
                 path = path.encode(sys.getfilesystemencoding(), 'replace')
-            path = path.lower()
-            for pattern in self.excludes:
-                if fnmatch.fnmatch(path, pattern):
-                    return
+            if self.excludes.match(path.lower()):
+                return
         try:
             artist = utf8urlencode(item['artist'])
             title = utf8urlencode(item['title'])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# tests for rePear, the iPod database management tool
+# Copyright (C) 2008 Martin J. Fiedler <martin.fiedler@gmx.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys, os, shutil, tempfile, unittest, cStringIO
+import repear
+
+
+################################################################################
+## move_file()                                                                ##
+################################################################################
+
+class MoveFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="repear-test-")
+        self.src = os.path.join(self.dir, "source.mp3")
+        self.touch(self.src)
+        # capture the console output
+        self.stdout = sys.stdout
+        sys.stdout = self.output = cStringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.dir, True)
+
+    def touch(self, filename):
+        f = open(filename, "wb")
+        f.write("data")
+        f.close()
+
+    def assertFailed(self, result, expected):
+        self.assertEqual(result, expected)
+        output = self.output.getvalue()
+        self.assert_("[FAILED]" in output, output)
+        self.assert_("ERROR: " in output, output)
+
+    def testMove(self):
+        dest = os.path.join(self.dir, "sub", "dest.mp3")
+        self.assertEqual(repear.move_file(self.src, dest), None)
+        self.assert_(os.path.isfile(dest))
+        self.assert_(not os.path.exists(self.src))
+
+    def testMissingSource(self):
+        missing = os.path.join(self.dir, "missing.mp3")
+        self.assertFailed(repear.move_file(missing, os.path.join(self.dir, "dest.mp3")), 'missing')
+
+    def testExistingDestination(self):
+        dest = os.path.join(self.dir, "dest.mp3")
+        self.touch(dest)
+        self.assertFailed(repear.move_file(self.src, dest), 'exists')
+        self.assert_(os.path.isfile(self.src))
+
+    def testUncreatableDirectory(self):
+        # a file is in the way of the destination directory
+        blocker = os.path.join(self.dir, "blocker")
+        self.touch(blocker)
+        dest = os.path.join(blocker, "sub", "dest.mp3")
+        self.assertFailed(repear.move_file(self.src, dest), 'mkdir')
+        self.assert_(os.path.isfile(self.src))
+
+    def testRenameError(self):
+        # a directory can't be replaced by a file
+        dest = os.path.join(self.dir, "dest.mp3")
+        os.mkdir(dest)
+        self.assertFailed(repear.move_file(self.src, dest), 'move')
+        self.assert_(os.path.isfile(self.src))
+
+
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
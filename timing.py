@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# phase timing library for rePear, the iPod database management tool
+# Copyright (C) 2008 Martin J. Fiedler <martin.fiedler@gmx.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys, os, time, heapq
+try:
+    import json
+except ImportError:
+    json = None
+
+
+################################################################################
+## a simple JSON encoder for Python versions without the json module          ##
+################################################################################
+
+def to_json(obj, indent=0):
+    pad = "\n" + (indent + 2) * " "
+    if isinstance(obj, dict):
+        if not obj: return "{}"
+        keys = obj.keys()
+        keys.sort()
+        items = ["%s: %s" % (to_json(unicode(key)), to_json(obj[key], indent + 2)) for key in keys]
+        return "{" + pad + ("," + pad).join(items) + "\n" + indent * " " + "}"
+    if isinstance(obj, (list, tuple)):
+        if not obj: return "[]"
+        items = [to_json(item, indent + 2) for item in obj]
+        return "[" + pad + ("," + pad).join(items) + "\n" + indent * " " + "]"
+    if isinstance(obj, basestring):
+        if isinstance(obj, str):
+            obj = unicode(obj, 'iso-8859-1')
+        res = []
+        for c in obj:
+            if c in u'"\\':
+                res.append('\\' + str(c))
+            elif (c < u' ') or (c > u'~'):
+                res.append('\\u%04x' % ord(c))
+            else:
+                res.append(str(c))
+        return '"' + "".join(res) + '"'
+    if obj is None:
+        return "null"
+    if obj is True:
+        return "true"
+    if obj is False:
+        return "false"
+    if isinstance(obj, float):
+        return "%.6f" % obj
+    return str(obj)
+
+def dump_json(obj, f):
+    if json:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    else:
+        f.write(to_json(obj))
+    f.write("\n")
+
+
+################################################################################
+## phase timer                                                                ##
+################################################################################
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.items = 0
+        self.slowest = []  # min-heap of (seconds, item)
+
+    def report(self):
+        slowest = self.slowest[:]
+        slowest.sort()
+        slowest.reverse()
+        return {
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'calls': self.calls,
+            'items': self.items,
+            'slowest': [{ 'item': decode(item), 'seconds': seconds } for seconds, item in slowest]
+        }
+
+def decode(item):
+    if isinstance(item, str):
+        return unicode(item, sys.getfilesystemencoding() or 'iso-8859-1', 'replace')
+    return item
+
+
+# Phases are timed with begin() and end(), which may be nested. Things that
+# happen too often to justify a begin()/end() pair (e.g. parsing a single
+# file) can be accounted with measure(), which also remembers the slowest
+# items. Counters are simple named integers.
+class PhaseTimer:
+    def __init__(self, slowest=10):
+        self.max_slowest = slowest
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.order = []
+        self.stack = []
+        self.counters = {}
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time()
+
+    def phase(self, name):
+        try:
+            return self.phases[name]
+        except KeyError:
+            self.phases[name] = phase = Phase(name)
+            self.order.append(name)
+            return phase
+
+    def begin(self, name):
+        self.stack.append((self.phase(name), time.time(), cpu_time()))
+
+    def end(self, items=None):
+        if not self.stack:
+            return
+        phase, wall, cpu = self.stack.pop()
+        phase.wall += time.time() - wall
+        phase.cpu += cpu_time() - cpu
+        phase.calls += 1
+        if items:
+            phase.items += items
+
+    def measure(self, name, seconds, item=None):
+        phase = self.phase(name)
+        phase.wall += seconds
+        phase.calls += 1
+        phase.items += 1
+        if item is None:
+            return
+        if len(phase.slowest) < self.max_slowest:
+            heapq.heappush(phase.slowest, (seconds, item))
+        elif seconds > phase.slowest[0][0]:
+            heapq.heapreplace(phase.slowest, (seconds, item))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        # close all phases that are still open
+        while self.stack:
+            self.end()
+        return {
+            'wall': time.time() - self.start_wall,
+            'cpu': cpu_time() - self.start_cpu,
+            'order': self.order[:],
+            'phases': dict([(name, phase.report()) for name, phase in self.phases.iteritems()]),
+            'counters': self.counters.copy()
+        }
+
+    def write(self, filename):
+        f = open(filename, "w")
+        try:
+            dump_json(self.report(), f)
+        finally:
+            f.close()
+
+# the global timer instance used by all rePear modules
+timer = PhaseTimer()
+
+
+################################################################################
+
+if __name__ == "__main__":
+    print "Do not start this file directly, start repear.py instead."